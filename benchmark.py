@@ -0,0 +1,298 @@
+"""Offline benchmark of the pipeline and map renderers on synthetic shipment files.
+
+Every run geocodes against a local mock Nominatim server with a fresh cache,
+so results don't depend on the network or on earlier runs.
+
+    python benchmark.py
+    python benchmark.py --rows 10000 --scenarios standard volume --latency 0.05 --json results.json
+"""
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+import geocoding
+import pipeline
+from cli import SCENARIO_NAMES
+from geocache import GeocodeCache
+from geocoding import configure_engine, NominatimBackend
+from profiling import profiler
+from rendering import new_map, render_html, plot_scenario, warehouse_colors, DOT_SIZE, LAYER_COLORS
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+TEMPLATE_FILES = {
+    "Standard visualization": "Standard template.xlsx",
+    "Volume visualization": "Volume template.xlsx",
+    "Supply-chain visualization": "Supply-chain template.xlsx",
+    "Distance calculation": "Distance calculation template.xlsx",
+    "Nearest warehouse assignment": "Nearest warehouse template.xlsx",
+}
+DEFAULT_ROWS = (1_000, 10_000, 100_000)
+WAREHOUSES = 10  # Distinct warehouses in synthetic supply-chain files
+
+# Rough (south, west, north, east) boxes the mock geocoder places each country's addresses in.
+# They don't overlap, so reverse lookups can tell the country from the point alone.
+COUNTRY_BOXES = {
+    "DE": (47.3, 5.9, 55.0, 15.0),
+    "FR": (43.0, -1.0, 49.0, 5.5),
+    "NL": (51.0, 4.0, 53.5, 5.8),
+    "PL": (49.5, 15.5, 54.5, 23.5),
+    "IT": (38.0, 8.0, 45.5, 16.0),
+    "ES": (37.0, -8.0, 42.8, -1.5),
+    "GB": (50.5, -5.0, 55.0, -1.5),
+    "US": (30.0, -120.0, 45.0, -75.0),
+}
+
+
+class MockNominatim:
+    """Local stand-in for the Nominatim search and reverse endpoints.
+
+    Answers are deterministic per query: a point inside the country's box, or
+    no result for roughly `miss_rate` of the queries. Address details are only
+    included when asked for with addressdetails=1, like the real service.
+    """
+
+    def __init__(self, latency=0.02, miss_rate=0.05):
+        self.latency = latency
+        self.miss_rate = miss_rate
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    @staticmethod
+    def _fraction(text, salt):
+        digest = hashlib.sha256(f"{salt}:{text}".encode()).digest()
+        return int.from_bytes(digest[:8], 'big') / 2 ** 64
+
+    def _search(self, params):
+        if 'q' in params:
+            query = params['q'][0]
+            country_code = query.replace(",", " ").split()[-1].upper()
+        else:
+            query = "|".join(f"{name}={values[0]}" for name, values in sorted(params.items()))
+            country_code = (params.get('countrycodes') or params.get('country') or [""])[0].split(",")[0].upper()
+
+        if country_code not in COUNTRY_BOXES or self._fraction(query, "miss") < self.miss_rate:
+            return []
+        south, west, north, east = COUNTRY_BOXES[country_code]
+        place = {
+            'lat': str(south + (north - south) * self._fraction(query, "lat")),
+            'lon': str(west + (east - west) * self._fraction(query, "lon")),
+            'display_name': query,
+        }
+        if params.get('addressdetails', ["0"])[0] == "1":
+            place['address'] = {'country_code': country_code.lower()}
+        return [place]
+
+    def _reverse(self, params):
+        lat, lon = float(params['lat'][0]), float(params['lon'][0])
+        for country_code, (south, west, north, east) in COUNTRY_BOXES.items():
+            if south <= lat <= north and west <= lon <= east:
+                return {'lat': str(lat), 'lon': str(lon), 'display_name': country_code,
+                        'address': {'country_code': country_code.lower()}}
+        return {'error': "Unable to geocode"}
+
+    def start(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with mock._lock:
+                    mock.requests += 1
+                time.sleep(mock.latency)
+
+                url = urlparse(self.path)
+                params = parse_qs(url.query)
+                body = mock._reverse(params) if url.path.startswith("/reverse") else mock._search(params)
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="mock-nominatim", daemon=True).start()
+        return f"127.0.0.1:{self._server.server_port}"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+# Function to read the column layout of a scenario's template
+def template_columns(scenario):
+    columns = list(pd.read_excel(os.path.join(TEMPLATES_DIR, TEMPLATE_FILES[scenario]), nrows=0).columns)
+    # Address columns without a suffix are the destination where the scenario expects a _dest group
+    required = pipeline.REQUIRED_COLUMNS[scenario]
+    return [f"{column}_dest" if column not in required and f"{column}_dest" in required else column
+            for column in columns]
+
+# Function to draw a pool of distinct addresses spread over the mock geocoder's countries
+def synthetic_addresses(count, rng):
+    return pd.DataFrame({
+        'country_code': rng.choice(list(COUNTRY_BOXES), count),
+        'postal_code': [f"{code:05d}" for code in rng.integers(0, 100_000, count)],
+        'city': [f"Town {i}" for i in range(count)],
+    })
+
+# Function to spread the addresses of the pool over the rows, using every address at least once
+def _address_rows(pool, rows, rng):
+    indexes = np.concatenate([np.arange(len(pool)), rng.integers(0, len(pool), max(0, rows - len(pool)))])[:rows]
+    return pool.iloc[rng.permutation(indexes)].reset_index(drop=True)
+
+# Function to build a synthetic file for a scenario; duplication is the share of rows repeating an earlier address
+def synthetic_sheet(scenario, rows, duplication=0.9, seed=0):
+    rng = np.random.default_rng(seed)
+    columns = template_columns(scenario)
+    pool = synthetic_addresses(max(1, round(rows * (1 - duplication))), rng)
+
+    df = pd.DataFrame(index=range(rows))
+    for suffix in ("", "_orig", "_dest", "_warehouse"):
+        if f"country_code{suffix}" not in columns:
+            continue
+        # Few warehouses ship to many destinations
+        source = pool.head(WAREHOUSES) if suffix == "_warehouse" else pool
+        addresses = _address_rows(source, rows, rng)
+        for field in addresses.columns:
+            df[f"{field}{suffix}"] = addresses[field]
+    if 'layer' in columns:
+        df['layer'] = rng.integers(1, 11, rows)
+    if 'volume' in columns:
+        df['volume'] = rng.integers(1, 1000, rows)
+    return df[columns]
+
+# Function to render a scenario's map the way the app does and return the HTML size in bytes
+def render_map(df, scenario, batched=True, volume_display="Dots per row", tiled=False):
+    if scenario == "Distance calculation":
+        return None  # The app shows no map for distances
+    # App defaults; pipeline.process has already assigned the nearest warehouses the map is colored by
+    styling = {
+        'layer_colors': (warehouse_colors(df['warehouse_1'].dropna())
+                         if scenario == "Nearest warehouse assignment" else LAYER_COLORS),
+        'dot_size': DOT_SIZE,
+        'batched': batched,
+        'tiled': tiled,
+        'volume_display': volume_display,
+        'grid_precision': "Auto",
+        'flow_lines': "One line per lane",
+    }
+    map_object = new_map()
+    with profiler.stage("prepare map layers"):
+        plot_scenario(map_object, df, scenario, styling)
+    with profiler.stage("map HTML generation"):
+        html = render_html(map_object)
+    return len(html.encode())
+
+# Function to run one file through the pipeline and map rendering with a fresh cache, measuring it
+def run_case(path, scenario, mock, cache_path, batched=True, volume_display="Dots per row", tiled=False):
+    geocoding.geocode_cache = GeocodeCache(cache_path)
+    profiler.reset()
+    requests_before = mock.requests
+
+    # tracemalloc slows down allocation heavy code, so compare timings only between runs that both measured memory
+    tracemalloc.start()
+    started = time.perf_counter()
+    with profiler.stage("read input"):
+        df = pipeline.read_table(path)
+    pipeline.process(df, scenario)
+    html_bytes = render_map(df, scenario, batched, volume_display, tiled)
+    seconds = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    snapshot = profiler.snapshot()
+    addresses = sum(count for name, count in snapshot['counters'].items() if name.startswith('lookups.'))
+    geocoding_seconds = snapshot['stages'].get('geocoding', {}).get('total_seconds', 0.0)
+    return {
+        'scenario': scenario,
+        'rows': len(df),
+        'unique_addresses': addresses,
+        'geocoder_requests': mock.requests - requests_before,
+        'seconds': seconds,
+        'rows_per_second': len(df) / seconds if seconds else None,
+        'addresses_per_second': addresses / geocoding_seconds if geocoding_seconds else None,
+        'peak_memory_mb': peak / 2 ** 20,
+        'map_html_kb': html_bytes / 1024 if html_bytes is not None else None,
+        'profile': snapshot,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic files against a mock geocoder.")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIO_NAMES, default=list(SCENARIO_NAMES))
+    parser.add_argument("--rows", nargs="+", type=int, default=list(DEFAULT_ROWS))
+    parser.add_argument("--duplication", type=float, default=0.9,
+                        help="Share of rows repeating an address used by another row (default: 0.9)")
+    parser.add_argument("--format", default="xlsx", dest="input_format",
+                        choices=[extension.lstrip(".") for extension in pipeline.INPUT_EXTENSIONS],
+                        help="File format of the synthetic inputs (default: xlsx, like the templates)")
+    parser.add_argument("--latency", type=float, default=0.02, help="Mock geocoder latency per request in seconds")
+    parser.add_argument("--miss-rate", type=float, default=0.05, help="Share of mock searches without a result")
+    parser.add_argument("--rps", type=float, default=1000, help="Geocoder requests per second (default: 1000)")
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent geocoding workers (default: 8)")
+    parser.add_argument("--unbatched", action="store_true", help="Render one map object per point")
+    parser.add_argument("--tiled", action="store_true", help="Serve the points from the local tile server")
+    parser.add_argument("--volume-display", default="Dots per row", choices=("Dots per row", "Aggregated grid"))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", help="Keep the synthetic files in this directory")
+    parser.add_argument("--json", metavar="PATH", help="Write the results, including stage profiles, as JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    mock = MockNominatim(latency=args.latency, miss_rate=args.miss_rate)
+    geocoding.engine.backend = NominatimBackend(domain=mock.start(), scheme="http", user_agent="benchmark")
+    geocoding.gazetteer = None  # Measure the online path, not whatever gazetteer is installed
+    configure_engine(requests_per_second=args.rps, workers=args.workers)
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        data_dir = args.data_dir or work_dir
+        os.makedirs(data_dir, exist_ok=True)
+        try:
+            for name in args.scenarios:
+                scenario = SCENARIO_NAMES[name]
+                for rows in args.rows:
+                    path = os.path.join(data_dir, f"{name}_{rows}.{args.input_format}")
+                    pipeline.write_output(synthetic_sheet(scenario, rows, args.duplication, args.seed),
+                                          path, args.input_format)
+
+                    cache_path = os.path.join(work_dir, f"cache_{name}_{rows}.sqlite")
+                    result = run_case(path, scenario, mock, cache_path,
+                                      batched=not args.unbatched, volume_display=args.volume_display,
+                                      tiled=args.tiled)
+                    results.append(result)
+                    map_size = f", map {result['map_html_kb']:,.0f} KB" if result['map_html_kb'] is not None else ""
+                    print(f"{name:>12} {rows:>8} rows: {result['seconds']:7.1f}s, "
+                          f"{result['rows_per_second']:9,.0f} rows/s, peak {result['peak_memory_mb']:7.1f} MB"
+                          f"{map_size}", flush=True)
+        finally:
+            mock.stop()
+
+    summary = pd.DataFrame([{key: value for key, value in result.items() if key != 'profile'} for result in results])
+    print()
+    print(summary.to_string(index=False, float_format=lambda value: f"{value:,.1f}"))
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump({'settings': vars(args), 'results': results}, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+GEOHASH_ALPHABET = np.array(list("0123456789bcdefghjkmnpqrstuvwxyz"))
+MIN_PRECISION = 1
+MAX_PRECISION = 8
+
+TARGET_CELL_PX = 24  # Aim for cells about this many pixels wide at the map's zoom
+MAP_WIDTH_PX = 700  # Size of the map rendered by folium_static
+MAP_HEIGHT_PX = 500
+
+
+def _bits(precision):
+    # Geohash interleaves longitude and latitude bits, starting with longitude
+    total = 5 * precision
+    return (total + 1) // 2, total // 2
+
+
+def geohash_cells(lats, lons, precision):
+    """Return the integer geohash cell index of every point at the given precision."""
+    lon_bits, lat_bits = _bits(precision)
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    lat_index = np.clip(((lats + 90) / 180 * (1 << lat_bits)).astype(np.int64), 0, (1 << lat_bits) - 1)
+    lon_index = np.clip(((lons + 180) / 360 * (1 << lon_bits)).astype(np.int64), 0, (1 << lon_bits) - 1)
+
+    cells = np.zeros(len(lats), dtype=np.int64)
+    for bit in range(5 * precision):
+        # Even positions (counted from the most significant bit) hold longitude bits
+        if bit % 2 == 0:
+            value = (lon_index >> (lon_bits - 1 - bit // 2)) & 1
+        else:
+            value = (lat_index >> (lat_bits - 1 - bit // 2)) & 1
+        cells = (cells << 1) | value
+    return cells
+
+
+def geohash_strings(cells, precision):
+    """Encode integer cell indexes as geohash strings."""
+    cells = np.asarray(cells, dtype=np.int64)
+    characters = [GEOHASH_ALPHABET[(cells >> (5 * (precision - 1 - i))) & 31] for i in range(precision)]
+    return np.array(["".join(chars) for chars in zip(*characters)]) if len(cells) else np.array([], dtype=str)
+
+
+def cell_bounds(cells, precision):
+    """Return (south, west, north, east) arrays of the given geohash cells."""
+    lon_bits, lat_bits = _bits(precision)
+    cells = np.asarray(cells, dtype=np.int64)
+    lat_index = np.zeros(len(cells), dtype=np.int64)
+    lon_index = np.zeros(len(cells), dtype=np.int64)
+    for bit in range(5 * precision):
+        value = (cells >> (5 * precision - 1 - bit)) & 1
+        if bit % 2 == 0:
+            lon_index = (lon_index << 1) | value
+        else:
+            lat_index = (lat_index << 1) | value
+
+    lat_size = 180 / (1 << lat_bits)
+    lon_size = 360 / (1 << lon_bits)
+    south = lat_index * lat_size - 90
+    west = lon_index * lon_size - 180
+    return south, west, south + lat_size, west + lon_size
+
+
+def zoom_for_bounds(south, west, north, east, width_px=MAP_WIDTH_PX, height_px=MAP_HEIGHT_PX, max_zoom=18):
+    """Approximate the zoom level Leaflet's fitBounds picks for the given bounds."""
+    def mercator_y(lat):
+        lat = math.radians(max(min(lat, 85.0511), -85.0511))
+        return math.log(math.tan(math.pi / 4 + lat / 2))
+
+    lon_fraction = max(east - west, 1e-9) / 360
+    lat_fraction = max(mercator_y(north) - mercator_y(south), 1e-9) / (2 * math.pi)
+    zoom = min(math.log2(width_px / 256 / lon_fraction), math.log2(height_px / 256 / lat_fraction))
+    return int(max(0, min(max_zoom, math.floor(zoom))))
+
+
+def precision_for_zoom(zoom, target_cell_px=TARGET_CELL_PX):
+    """Pick the geohash precision whose cells come closest to target_cell_px wide at this zoom."""
+    target_degrees = 360 / (256 * 2 ** zoom) * target_cell_px
+
+    def cell_width(precision):
+        return 360 / (1 << _bits(precision)[0])
+
+    return min(range(MIN_PRECISION, MAX_PRECISION + 1),
+               key=lambda precision: abs(math.log(cell_width(precision) / target_degrees)))
+
+
+def aggregate_volume(lats, lons, volumes, precision):
+    """Sum volumes per geohash cell.
+
+    Returns one row per non-empty cell with its geohash, number of points,
+    total volume, volume-weighted centroid and bounds.
+    """
+    points = pd.DataFrame({
+        'lat': np.asarray(lats, dtype=float),
+        'lon': np.asarray(lons, dtype=float),
+        'volume': pd.to_numeric(pd.Series(np.asarray(volumes)), errors='coerce').fillna(0).to_numpy(),
+    })
+    # Points that failed to geocode can't be binned
+    points = points[np.isfinite(points['lat']) & np.isfinite(points['lon'])].copy()
+    points['cell'] = geohash_cells(points['lat'], points['lon'], precision)
+    points['lat_weighted'] = points['lat'] * points['volume']
+    points['lon_weighted'] = points['lon'] * points['volume']
+
+    cells = points.groupby('cell', sort=False).agg(
+        count=('lat', 'size'),
+        volume=('volume', 'sum'),
+        lat_mean=('lat', 'mean'),
+        lon_mean=('lon', 'mean'),
+        lat_weighted=('lat_weighted', 'sum'),
+        lon_weighted=('lon_weighted', 'sum'),
+    ).reset_index()
+
+    # Fall back to the plain mean for cells without any volume
+    has_volume = cells['volume'] != 0
+    cells['lat'] = np.where(has_volume, cells['lat_weighted'] / cells['volume'].where(has_volume, 1), cells['lat_mean'])
+    cells['lon'] = np.where(has_volume, cells['lon_weighted'] / cells['volume'].where(has_volume, 1), cells['lon_mean'])
+
+    cells['geohash'] = geohash_strings(cells['cell'].to_numpy(), precision)
+    cells['south'], cells['west'], cells['north'], cells['east'] = cell_bounds(cells['cell'].to_numpy(), precision)
+    return cells[['geohash', 'count', 'volume', 'lat', 'lon', 'south', 'west', 'north', 'east']]
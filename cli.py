@@ -0,0 +1,142 @@
+"""Headless batch entry point running the same pipeline as the Streamlit app.
+
+All input files, and every sheet of each workbook, are geocoded together in
+one pass, so addresses shared between them are looked up once. Results are
+written back out per source unless --combined is given.
+
+    python cli.py shipments.xlsx --scenario standard
+    python cli.py exports/ --scenario distance --format parquet --output-dir results/
+    python cli.py week_*.xlsx --scenario supply-chain --combined
+    python cli.py network.xlsx --scenario nearest-warehouse --nearest 3
+"""
+import argparse
+import os
+import sys
+import time
+
+import pipeline
+from distance import DISTANCE_METHODS
+from geocoding import configure_engine
+from profiling import profiler
+from spatial_index import MAX_NEAREST
+
+# Short command-line names for the scenarios
+SCENARIO_NAMES = {
+    'standard': "Standard visualization",
+    'volume': "Volume visualization",
+    'supply-chain': "Supply-chain visualization",
+    'distance': "Distance calculation",
+    'nearest-warehouse': "Nearest warehouse assignment",
+}
+
+
+# Argument type for counts and rates that must be above zero
+def positive(number_type):
+    def parse(text):
+        value = number_type(text)
+        if not value > 0:
+            raise argparse.ArgumentTypeError(f"must be positive, got {text}")
+        return value
+    return parse
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Geocode shipment files without the Streamlit UI.")
+    parser.add_argument("inputs", nargs="+", help="xlsx, csv or parquet files, or directories containing them")
+    parser.add_argument("--scenario", required=True, choices=SCENARIO_NAMES)
+    parser.add_argument("--output-dir", default=".", help="Directory for the result files (default: current)")
+    parser.add_argument("--format", default="xlsx", choices=pipeline.OUTPUT_FORMATS, dest="output_format")
+    parser.add_argument("--distance-method", default="haversine", choices=DISTANCE_METHODS)
+    parser.add_argument("--distance-matrix", action="store_true",
+                        help="Also write the full origin x destination matrix (distance scenario only)")
+    parser.add_argument("--nearest", type=int, default=1, choices=range(1, MAX_NEAREST + 1), metavar="K",
+                        help="Nearest warehouses listed per destination (nearest-warehouse scenario only, default: 1)")
+    parser.add_argument("--combined", action="store_true",
+                        help="Write one output for the whole batch, with a source column, instead of one per source")
+    parser.add_argument("--rps", type=positive(float), help="Geocoder requests per second (default: GEOCODER_RPS or 1)")
+    parser.add_argument("--workers", type=positive(int), help="Concurrent geocoding workers (default: GEOCODER_WORKERS or 4)")
+    parser.add_argument("--profile", metavar="PATH", help="Write stage timings and geocoding counters as JSON")
+    parser.add_argument("--quiet", action="store_true", help="Don't print progress")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenario = SCENARIO_NAMES[args.scenario]
+    configure_engine(requests_per_second=args.rps, workers=args.workers)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    def log(message, end="\n"):
+        if not args.quiet:
+            print(message, end=end, file=sys.stderr, flush=True)
+
+    def progress(done, total):
+        # Roughly every percent, so huge files don't flood the terminal
+        if done == total or done % max(1, total // 100) == 0:
+            log(f"\r  geocoding unique addresses: {done}/{total}", end="" if done < total else "\n")
+
+    # Read every sheet of every input and check it against the scenario's template
+    failed = 0
+    frames = {}
+    paths = [path for source in args.inputs for path in pipeline.input_files(source)]
+    for path in paths:
+        log(f"{path}")
+        try:
+            with profiler.stage("read input"):
+                sheets = pipeline.read_sheets(path)
+        except (ValueError, OSError) as e:
+            log(f"  skipped: {e}")
+            failed += 1
+            continue
+
+        for sheet, df in sheets.items():
+            label = pipeline.source_label(path, sheet, len(sheets))
+            try:
+                pipeline.validate_template(df, scenario)
+            except pipeline.TemplateError as e:
+                log(f"  skipped {label}: {e}")
+                failed += 1
+                continue
+            if args.output_format == 'xlsx' and not args.combined and len(df) > pipeline.EXCEL_MAX_ROWS:
+                log(f"  skipped {label}: {len(df)} rows don't fit in an Excel sheet, use --format csv or parquet")
+                failed += 1
+                continue
+            label = pipeline.add_source(frames, label, df)
+            log(f"  {label}: {len(df)} rows")
+
+    # Checked before geocoding, so an oversized batch fails right away instead of after the whole run
+    batch_rows = sum(len(df) for df in frames.values())
+    if args.output_format == 'xlsx' and args.combined and batch_rows > pipeline.EXCEL_MAX_ROWS:
+        log(f"batch of {batch_rows} rows doesn't fit in an Excel sheet, use --format csv or parquet")
+        failed += len(frames)
+        frames = {}
+
+    if frames:
+        # One geocoding pass over the whole batch, so addresses shared between sources are resolved once
+        started = time.perf_counter()
+        df = pipeline.combine_sources(frames)
+        pipeline.process(df, scenario, distance_method=args.distance_method, progress_callback=progress,
+                         nearest_warehouses=args.nearest)
+        log(f"processed {len(df)} rows from {len(frames)} source(s) in {time.perf_counter() - started:.1f}s")
+
+        outputs = {"batch": df} if args.combined else pipeline.split_by_source(df)
+        for label, result in outputs.items():
+            basename = os.path.join(args.output_dir, pipeline.export_basename(label))
+            output_path = f"{basename}.{args.output_format}"
+            with profiler.stage("write output"):
+                pipeline.write_output(result, output_path, args.output_format)
+            log(f"  wrote {len(result)} rows to {output_path}")
+
+            if args.distance_matrix and scenario == "Distance calculation":
+                with profiler.stage("distance matrix"):
+                    pipeline.write_distance_matrix(result, f"{basename}_distance_matrix.csv.gz", args.distance_method)
+
+    if args.profile:
+        with open(args.profile, 'w') as profile_file:
+            profile_file.write(profiler.to_json())
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
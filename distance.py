@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+from geographiclib.geodesic import Geodesic
+
+EARTH_RADIUS_KM = 6371.0088  # Mean earth radius used by the haversine formula
+
+# WGS-84 ellipsoid, the same one geopy.distance.geodesic uses
+WGS84_A_KM = 6378.137
+WGS84_F = 1 / 298.257223563
+WGS84_B_KM = (1 - WGS84_F) * WGS84_A_KM
+
+DISTANCE_METHODS = ("haversine", "ellipsoidal")
+MAX_CHUNK_CELLS = 1_000_000  # Upper bound on pairs evaluated at once, keeps temporaries around 10 MB each
+
+
+def _as_radians(*values):
+    return np.broadcast_arrays(*(np.radians(np.asarray(value, dtype=float)) for value in values))
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance in km on a spherical earth, broadcast over array inputs."""
+    lat1, lon1, lat2, lon2 = _as_radians(lat1, lon1, lat2, lon2)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def ellipsoidal_km(lat1, lon1, lat2, lon2, max_iterations=200, tolerance=1e-12):
+    """Distance in km on the WGS-84 ellipsoid, broadcast over array inputs.
+
+    Uses Vincenty's inverse formula for the whole batch and falls back to
+    geographiclib for the (nearly antipodal) pairs where it does not converge.
+    """
+    lat1, lon1, lat2, lon2 = _as_radians(lat1, lon1, lat2, lon2)
+    shape = lat1.shape
+    # At least 1-d, so single pairs can be indexed for the fallback below like arrays
+    lat1, lon1, lat2, lon2 = np.atleast_1d(lat1, lon1, lat2, lon2)
+    finite = np.isfinite(lat1) & np.isfinite(lon1) & np.isfinite(lat2) & np.isfinite(lon2)
+
+    U1 = np.arctan((1 - WGS84_F) * np.tan(lat1))
+    U2 = np.arctan((1 - WGS84_F) * np.tan(lat2))
+    sin_U1, cos_U1 = np.sin(U1), np.cos(U1)
+    sin_U2, cos_U2 = np.sin(U2), np.cos(U2)
+    L = lon2 - lon1
+    lam = L.copy()
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(max_iterations):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.sqrt((cos_U2 * sin_lam) ** 2 + (cos_U1 * sin_U2 - sin_U1 * cos_U2 * cos_lam) ** 2)
+            cos_sigma = sin_U1 * sin_U2 + cos_U1 * cos_U2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(sin_sigma == 0, 0.0, cos_U1 * cos_U2 * sin_lam / sin_sigma)
+            cos2_alpha = 1 - sin_alpha ** 2
+            # Equatorial lines have cos2_alpha == 0
+            cos_2sigma_m = np.where(cos2_alpha == 0, 0.0, cos_sigma - 2 * sin_U1 * sin_U2 / cos2_alpha)
+            C = WGS84_F / 16 * cos2_alpha * (4 + WGS84_F * (4 - 3 * cos2_alpha))
+            lam_previous = lam
+            lam = L + (1 - C) * WGS84_F * sin_alpha * (
+                sigma + C * sin_sigma * (cos_2sigma_m + C * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)))
+            converged = np.abs(lam - lam_previous) < tolerance
+            if np.all(converged | ~finite):
+                break
+
+        u2 = cos2_alpha * (WGS84_A_KM ** 2 - WGS84_B_KM ** 2) / WGS84_B_KM ** 2
+        A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+        B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+        delta_sigma = B * sin_sigma * (cos_2sigma_m + B / 4 * (
+            cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)
+            - B / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)))
+        distance = WGS84_B_KM * A * (sigma - delta_sigma)
+
+    distance = np.where(finite, distance, np.nan)
+    for index in zip(*np.nonzero(finite & ~converged)):
+        distance[index] = Geodesic.WGS84.Inverse(
+            np.degrees(lat1[index]), np.degrees(lon1[index]),
+            np.degrees(lat2[index]), np.degrees(lon2[index]))['s12'] / 1000
+    return distance.reshape(shape)[()]
+
+
+def _distance_function(method):
+    if method == "haversine":
+        return haversine_km
+    if method == "ellipsoidal":
+        return ellipsoidal_km
+    raise ValueError(f"Unknown distance method: {method}")
+
+
+def paired_distances_km(orig_lat, orig_lon, dest_lat, dest_lon, method="haversine"):
+    """Distance in km between each origin and the destination on the same row; NaN where either is missing."""
+    distance_function = _distance_function(method)
+    orig_lat, orig_lon, dest_lat, dest_lon = (np.asarray(values, dtype=float)
+                                              for values in (orig_lat, orig_lon, dest_lat, dest_lon))
+    distances = np.empty(len(orig_lat))
+    for start in range(0, len(orig_lat), MAX_CHUNK_CELLS):
+        rows = slice(start, start + MAX_CHUNK_CELLS)
+        distances[rows] = distance_function(orig_lat[rows], orig_lon[rows], dest_lat[rows], dest_lon[rows])
+    return distances
+
+
+def distance_matrix_chunks(orig_lat, orig_lon, dest_lat, dest_lon, method="haversine", max_cells=MAX_CHUNK_CELLS):
+    """Yield (row offset, block) pairs covering the full origin x destination distance matrix in km.
+
+    Each block holds whole origin rows against every destination, sized so that
+    at most max_cells pairs are computed at once.
+    """
+    distance_function = _distance_function(method)
+    orig_lat, orig_lon = np.asarray(orig_lat, dtype=float), np.asarray(orig_lon, dtype=float)
+    dest_lat, dest_lon = np.asarray(dest_lat, dtype=float), np.asarray(dest_lon, dtype=float)
+    rows_per_chunk = max(1, max_cells // max(1, len(dest_lat)))
+    for start in range(0, len(orig_lat), rows_per_chunk):
+        rows = slice(start, start + rows_per_chunk)
+        yield start, distance_function(orig_lat[rows, None], orig_lon[rows, None], dest_lat[None, :], dest_lon[None, :])
+
+
+def write_distance_matrix_csv(output, orig_labels, orig_lat, orig_lon, dest_labels, dest_lat, dest_lon,
+                              method="haversine", max_cells=MAX_CHUNK_CELLS):
+    """Write the origin x destination matrix (whole km) as CSV to a text file object, one chunk at a time."""
+    orig_labels = list(orig_labels)
+    pd.DataFrame(columns=['origin'] + list(dest_labels)).to_csv(output, index=False)
+    for start, block in distance_matrix_chunks(orig_lat, orig_lon, dest_lat, dest_lon, method, max_cells):
+        chunk = pd.DataFrame(np.floor(block), dtype='Int64')
+        chunk.insert(0, 'origin', orig_labels[start:start + len(block)])
+        chunk.to_csv(output, index=False, header=False)
@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+
+from binning import geohash_cells
+
+FLOW_DECIMALS = 5  # Ends closer than about a metre are the same place
+MIN_WEIGHT = 0.5  # Line weight of a lane with a single shipment
+MAX_WEIGHT = 6  # Line weight of the busiest lane
+WEIGHT_STEP = 0.5  # Weights are rounded to this, so lines can be drawn in a few batches
+BUNDLE_CELL_PX = 96  # Bundles gather the destinations of a cell about this many pixels wide
+
+
+def aggregate_flows(warehouse_lats, warehouse_lons, lats, lons, layers):
+    """Group shipments into lanes by (warehouse, destination, layer).
+
+    Returns one row per lane with the warehouse and destination coordinates,
+    the layer and the number of shipments on it. Rows missing either end
+    are left out.
+    """
+    shipments = pd.DataFrame({
+        'warehouse_lat': np.round(np.asarray(warehouse_lats, dtype=float), FLOW_DECIMALS),
+        'warehouse_lon': np.round(np.asarray(warehouse_lons, dtype=float), FLOW_DECIMALS),
+        'lat': np.round(np.asarray(lats, dtype=float), FLOW_DECIMALS),
+        'lon': np.round(np.asarray(lons, dtype=float), FLOW_DECIMALS),
+        'layer': np.asarray(layers, dtype=object),
+    })
+    shipments = shipments[np.isfinite(shipments[['warehouse_lat', 'warehouse_lon', 'lat', 'lon']]).all(axis=1)]
+    return (shipments.groupby(['warehouse_lat', 'warehouse_lon', 'lat', 'lon', 'layer'], sort=False, dropna=False)
+            .size().rename('count').reset_index())
+
+
+def flow_segments(lanes):
+    """One straight (warehouse, destination) segment per geographic lane, with its shipment count.
+
+    Lanes that only differ by layer share a line, so their counts are added up.
+    """
+    lines = lanes.groupby(['warehouse_lat', 'warehouse_lon', 'lat', 'lon'], sort=False)['count'].sum().reset_index()
+    segments = np.stack([lines[['warehouse_lat', 'warehouse_lon']].to_numpy(dtype=float),
+                         lines[['lat', 'lon']].to_numpy(dtype=float)], axis=1)
+    return segments, lines['count'].to_numpy()
+
+
+def bundle_flows(lanes, precision):
+    """Bundle lanes through the geohash cell of their destination.
+
+    Every warehouse gets one trunk line to the centre of each cell it ships
+    to, carrying the count of all lanes into that cell; from there a branch
+    runs to each destination. Returns (segments, counts) like flow_segments.
+    """
+    lines = lanes.groupby(['warehouse_lat', 'warehouse_lon', 'lat', 'lon'], sort=False)['count'].sum().reset_index()
+    lines['cell'] = geohash_cells(lines['lat'], lines['lon'], precision)
+
+    # The hub of a cell is the shipment-weighted centre of the destinations in it
+    hubs = lines.assign(lat_weighted=lines['lat'] * lines['count'], lon_weighted=lines['lon'] * lines['count'])
+    hubs = hubs.groupby('cell').agg(lat_weighted=('lat_weighted', 'sum'), lon_weighted=('lon_weighted', 'sum'),
+                                    count=('count', 'sum'))
+    hubs['hub_lat'] = hubs['lat_weighted'] / hubs['count']
+    hubs['hub_lon'] = hubs['lon_weighted'] / hubs['count']
+    lines = lines.join(hubs[['hub_lat', 'hub_lon']], on='cell')
+
+    trunks = lines.groupby(['warehouse_lat', 'warehouse_lon', 'hub_lat', 'hub_lon'], sort=False)['count'].sum().reset_index()
+    branches = lines.groupby(['hub_lat', 'hub_lon', 'lat', 'lon'], sort=False)['count'].sum().reset_index()
+    # The only destination of a cell is its own hub
+    branches = branches[(branches['hub_lat'] != branches['lat']) | (branches['hub_lon'] != branches['lon'])]
+
+    segments = np.concatenate([
+        np.stack([trunks[['warehouse_lat', 'warehouse_lon']].to_numpy(dtype=float),
+                  trunks[['hub_lat', 'hub_lon']].to_numpy(dtype=float)], axis=1),
+        np.stack([branches[['hub_lat', 'hub_lon']].to_numpy(dtype=float),
+                  branches[['lat', 'lon']].to_numpy(dtype=float)], axis=1),
+    ]).reshape(-1, 2, 2)
+    return segments, np.concatenate([trunks['count'].to_numpy(), branches['count'].to_numpy()])
+
+
+def flow_weights(counts):
+    """Line weight per lane, growing with the logarithm of its shipment count and rounded to WEIGHT_STEP."""
+    counts = np.asarray(counts, dtype=float)
+    if len(counts) == 0:
+        return counts
+    max_count = counts.max()
+    if max_count <= 1:
+        return np.full(len(counts), float(MIN_WEIGHT))
+    weights = MIN_WEIGHT + (MAX_WEIGHT - MIN_WEIGHT) * np.log(counts) / np.log(max_count)
+    return np.round(weights / WEIGHT_STEP) * WEIGHT_STEP
@@ -0,0 +1,140 @@
+import argparse
+import os
+import sqlite3
+import threading
+from zipfile import ZipFile
+
+import pandas as pd
+
+from distance import haversine_km
+
+# The gazetteer is optional: it is only used when this file exists
+DEFAULT_GAZETTEER_PATH = os.environ.get(
+    "GAZETTEER_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "gazetteer.sqlite"),
+)
+
+MAX_SPREAD_KM = 25  # Places sharing a postal code or name further apart than this are different locations
+
+# Column layout of the GeoNames postal code dumps (https://download.geonames.org/export/zip/)
+GEONAMES_COLUMNS = ['country_code', 'postal_code', 'place_name', 'admin_name1', 'admin_code1',
+                    'admin_name2', 'admin_code2', 'admin_name3', 'admin_code3',
+                    'latitude', 'longitude', 'accuracy']
+
+
+class PostalGazetteer:
+    """Read-only lookup of postal code and place coordinates from a local SQLite index.
+
+    Keys follow geocache.normalize_address: upper-case country and postal code,
+    case-folded place name.
+    """
+
+    def __init__(self, path=DEFAULT_GAZETTEER_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+
+    @classmethod
+    def open_if_available(cls, path=DEFAULT_GAZETTEER_PATH):
+        return cls(path) if os.path.isfile(path) else None
+
+    def _centroid(self, condition, params):
+        # Several places can share a postal code or a name; only a compact group of them is one location
+        row = self._conn.execute(
+            f"""SELECT AVG(latitude), AVG(longitude), MIN(latitude), MIN(longitude), MAX(latitude), MAX(longitude)
+                FROM postal_codes WHERE {condition}""",
+            params,
+        ).fetchone()
+        if row[0] is None or haversine_km(*row[2:]) > MAX_SPREAD_KM:
+            return None
+        return row[0], row[1]
+
+    def lookup(self, country_code, postal_code=None, city=None):
+        """Return (lat, lon, postal_code, city, country_code) like geocode_location, or None on a miss.
+
+        Places spread wider than MAX_SPREAD_KM (a Springfield in every state)
+        are ambiguous and count as a miss, so the online geocoder decides.
+        """
+        if not country_code or not (postal_code or city):
+            return None
+
+        with self._lock:
+            if postal_code:
+                found = None
+                if city:
+                    found = self._centroid("country_code = ? AND postal_code = ? AND place_name = ?",
+                                           (country_code, postal_code, city))
+                if found is None:
+                    found = self._centroid("country_code = ? AND postal_code = ?", (country_code, postal_code))
+                if found is not None:
+                    return found[0], found[1], postal_code, city, country_code
+
+            if city:
+                found = self._centroid("country_code = ? AND place_name = ?", (country_code, city))
+                if found is not None:
+                    return found[0], found[1], None, city, country_code
+
+        return None
+
+def _read_geonames(source, chunksize):
+    read_options = dict(sep='\t', header=None, names=GEONAMES_COLUMNS, dtype=str,
+                        keep_default_na=False, quoting=3, chunksize=chunksize)
+    if source.lower().endswith('.zip'):
+        # GeoNames archives ship the data file next to a readme.txt
+        with ZipFile(source) as archive:
+            member = next(name for name in archive.namelist()
+                          if name.lower().endswith('.txt') and 'readme' not in name.lower())
+            with archive.open(member) as data_file:
+                yield from pd.read_csv(data_file, **read_options)
+    else:
+        yield from pd.read_csv(source, **read_options)
+
+
+# Function to build the gazetteer index from a GeoNames-style postal code dump (.txt or .zip)
+def build_gazetteer(source, path=DEFAULT_GAZETTEER_PATH, chunksize=200_000):
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    conn = sqlite3.connect(tmp_path)
+    conn.execute(
+        """CREATE TABLE postal_codes (
+            country_code TEXT NOT NULL,
+            postal_code TEXT NOT NULL,
+            place_name TEXT NOT NULL,
+            latitude REAL NOT NULL,
+            longitude REAL NOT NULL
+        )"""
+    )
+
+    rows = 0
+    for chunk in _read_geonames(source, chunksize):
+        # Normalize the same way as geocache.normalize_address
+        chunk = pd.DataFrame({
+            'country_code': chunk['country_code'].str.strip().str.upper(),
+            'postal_code': chunk['postal_code'].str.split().str.join(' ').str.upper(),
+            'place_name': chunk['place_name'].str.split().str.join(' ').str.casefold(),
+            'latitude': pd.to_numeric(chunk['latitude'], errors='coerce'),
+            'longitude': pd.to_numeric(chunk['longitude'], errors='coerce'),
+        }).dropna(subset=['latitude', 'longitude'])
+        conn.executemany("INSERT INTO postal_codes VALUES (?, ?, ?, ?, ?)", chunk.itertuples(index=False, name=None))
+        rows += len(chunk)
+
+    # Build the indexes once after loading, which is much faster than maintaining them per insert
+    conn.execute("CREATE INDEX idx_postal_codes_postal ON postal_codes (country_code, postal_code)")
+    conn.execute("CREATE INDEX idx_postal_codes_place ON postal_codes (country_code, place_name)")
+    conn.commit()
+    conn.execute("VACUUM")
+    conn.close()
+    os.replace(tmp_path, path)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the offline postal code gazetteer from a GeoNames dump.")
+    parser.add_argument("source", help="GeoNames postal code file, e.g. allCountries.zip or DE.txt")
+    parser.add_argument("output", nargs="?", default=DEFAULT_GAZETTEER_PATH, help="SQLite file to write")
+    args = parser.parse_args()
+
+    count = build_gazetteer(args.source, args.output)
+    print(f"Indexed {count} postal codes into {args.output}")
@@ -0,0 +1,197 @@
+import os
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+# Default location of the cache file, next to the app unless overridden
+DEFAULT_CACHE_PATH = os.environ.get(
+    "GEOCODE_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "geocode_cache.sqlite"),
+)
+
+HIT_TTL = 90 * 24 * 3600  # Successful lookups are trusted for 90 days
+MISS_TTL = 7 * 24 * 3600  # Confirmed misses are retried after a week
+MAX_ENTRIES = 200_000  # Least recently used entries are evicted above this size
+EVICT_EVERY = 256  # Check the cache size every N writes
+
+EMPTY_RESULT = (None, None, None, None, None)
+
+
+def _clean(value):
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    # Postal codes read as numbers come back as floats (e.g. 10115.0)
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    value = " ".join(str(value).split())
+    if not value or value.lower() in ("nan", "none", "<na>"):
+        return None
+    return value
+
+
+# Function to normalize an address into the (country_code, postal_code, city) cache key
+def normalize_address(country_code, postal_code=None, city=None):
+    country_code = _clean(country_code)
+    postal_code = _clean(postal_code)
+    city = _clean(city)
+    return (
+        country_code.upper() if country_code else None,
+        postal_code.upper() if postal_code else None,
+        city.casefold() if city else None,
+    )
+
+
+class GeocodeCache:
+    """SQLite-backed cache of geocode_location results, keyed on the normalized address.
+
+    Both hits and confirmed misses are stored. Entries older than their TTL are
+    treated as absent by get() and can be re-resolved in bulk with refresh_stale().
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, hit_ttl=HIT_TTL, miss_ttl=MISS_TTL, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.hit_ttl = hit_ttl
+        self.miss_ttl = miss_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._connection = None
+
+    @property
+    def _conn(self):
+        # Opened on first use (always under the lock), so importing the app doesn't create the cache file
+        if self._connection is None:
+            self._connection = self._open()
+        return self._connection
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS geocode_cache (
+                country_code TEXT NOT NULL,
+                postal_code TEXT NOT NULL,
+                city TEXT NOT NULL,
+                latitude REAL,
+                longitude REAL,
+                result_postal_code TEXT,
+                result_city TEXT,
+                result_country_code TEXT,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (country_code, postal_code, city)
+            )"""
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_geocode_cache_last_used ON geocode_cache (last_used)")
+        conn.commit()
+        self._evict(conn)
+        return conn
+
+    @staticmethod
+    def _key(key):
+        # SQLite treats NULLs in a primary key as distinct, so store missing parts as ''
+        return tuple(part or "" for part in key)
+
+    def _expired(self, latitude, created_at, now):
+        ttl = self.miss_ttl if latitude is None else self.hit_ttl
+        return now - created_at > ttl
+
+    def get(self, key):
+        """Return the cached result tuple for a normalized key, or None if absent or expired."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                """SELECT latitude, longitude, result_postal_code, result_city, result_country_code, created_at
+                   FROM geocode_cache WHERE country_code = ? AND postal_code = ? AND city = ?""",
+                self._key(key),
+            ).fetchone()
+            if row is None or self._expired(row[0], row[5], now):
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE geocode_cache SET last_used = ? WHERE country_code = ? AND postal_code = ? AND city = ?",
+                (now, *self._key(key)),
+            )
+            self._conn.commit()
+            self.hits += 1
+        return tuple(row[:5])
+
+    def set(self, key, result):
+        """Store a result tuple (a miss is a tuple of Nones) for a normalized key."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO geocode_cache VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (*self._key(key), *result, now, now),
+            )
+            self._conn.commit()
+            self._writes += 1
+        if self._writes % EVICT_EVERY == 0:
+            self.evict()
+
+    def evict(self):
+        """Drop the least recently used entries once the cache grows past max_entries."""
+        with self._lock:
+            return self._evict(self._conn)
+
+    def _evict(self, conn):
+        (count,) = conn.execute("SELECT COUNT(*) FROM geocode_cache").fetchone()
+        if count <= self.max_entries:
+            return 0
+        # Evict down to 90% so we don't evict again on the very next write
+        excess = count - int(self.max_entries * 0.9)
+        conn.execute(
+            """DELETE FROM geocode_cache WHERE rowid IN (
+                   SELECT rowid FROM geocode_cache ORDER BY last_used LIMIT ?)""",
+            (excess,),
+        )
+        conn.commit()
+        return excess
+
+    def stale_keys(self):
+        """Return the normalized keys of all entries past their TTL."""
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute(
+                """SELECT country_code, postal_code, city FROM geocode_cache
+                   WHERE (latitude IS NULL AND created_at < ?) OR (latitude IS NOT NULL AND created_at < ?)""",
+                (now - self.miss_ttl, now - self.hit_ttl),
+            ).fetchall()
+        return [tuple(part or None for part in row) for row in rows]
+
+    def refresh_stale(self, resolve, progress_callback=None):
+        """Re-resolve every stale entry with resolve(country_code, postal_code, city).
+
+        resolve should raise on transient errors so that the stale entry is kept
+        rather than being overwritten with a miss. Returns the number refreshed.
+        """
+        keys = self.stale_keys()
+        refreshed = 0
+        for i, key in enumerate(keys):
+            try:
+                result = resolve(*key)
+            except Exception as e:
+                print(f"Cache refresh error for {key}: {e}")
+            else:
+                self.set(key, result)
+                refreshed += 1
+            if progress_callback:
+                progress_callback(i + 1, len(keys))
+        return refreshed
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            total, misses, stale = self._conn.execute(
+                """SELECT COUNT(*),
+                          COALESCE(SUM(latitude IS NULL), 0),
+                          COALESCE(SUM((latitude IS NULL AND created_at < ?) OR (latitude IS NOT NULL AND created_at < ?)), 0)
+                   FROM geocode_cache""",
+                (now - self.miss_ttl, now - self.hit_ttl),
+            ).fetchone()
+        return {"entries": total, "misses": misses, "stale": stale}
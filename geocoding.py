@@ -0,0 +1,362 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from functools import partial
+
+import pandas as pd
+from geopy.adapters import RequestsAdapter
+from geopy.exc import GeocoderRateLimited, GeocoderTimedOut
+from geopy.geocoders import Nominatim
+
+from gazetteer import PostalGazetteer
+from geocache import GeocodeCache, normalize_address, EMPTY_RESULT
+from profiling import profiler
+
+# Public Nominatim allows at most one request per second; self-hosted instances can go higher
+REQUESTS_PER_SECOND = float(os.environ.get("GEOCODER_RPS", "1"))
+WORKERS = int(os.environ.get("GEOCODER_WORKERS", "4"))
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0  # Seconds before the first retry, doubled on every attempt
+BACKOFF_MAX = 60.0
+
+
+class TokenBucket:
+    """Thread-safe token bucket handing out at most `rate` tokens per second."""
+
+    def __init__(self, rate, capacity=1):
+        if not rate > 0:
+            raise ValueError(f"Requests per second must be positive, got {rate}")
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # Hold back every worker, e.g. when the server told us to slow down
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+
+class GeocoderBackend:
+    """Interface for geocoding services.
+
+    geocode() and reverse() return a geopy Location (with the Nominatim-style
+    `raw` dict) or None, and raise geopy exceptions on errors.
+    """
+
+    def geocode(self, query, **kwargs):
+        raise NotImplementedError
+
+    def reverse(self, point, **kwargs):
+        raise NotImplementedError
+
+
+class NominatimBackend(GeocoderBackend):
+    """Nominatim API, either the public instance, a self-hosted one or a local mock server."""
+
+    def __init__(self, domain="nominatim.openstreetmap.org", scheme="https", user_agent="streamlit", timeout=10):
+        # The HTTP adapter would retry 429s and timeouts on its own, past the engine's token bucket and
+        # backoff; without its retries every attempt goes through GeocodingEngine._call
+        self.geolocator = Nominatim(user_agent=user_agent, domain=domain, scheme=scheme, timeout=timeout,
+                                    adapter_factory=partial(RequestsAdapter, max_retries=0))
+
+    def geocode(self, query, **kwargs):
+        return self.geolocator.geocode(query, **kwargs)
+
+    def reverse(self, point, **kwargs):
+        return self.geolocator.reverse(point, **kwargs)
+
+
+# Function to build the backend from the GEOCODER_* environment variables
+def backend_from_env():
+    return NominatimBackend(
+        domain=os.environ.get("GEOCODER_DOMAIN", "nominatim.openstreetmap.org"),
+        scheme=os.environ.get("GEOCODER_SCHEME", "https"),
+        user_agent=os.environ.get("GEOCODER_USER_AGENT", "streamlit"),
+        timeout=float(os.environ.get("GEOCODER_TIMEOUT", "10")),
+    )
+
+
+class GeocodingEngine:
+    """Runs geocoding requests on a worker pool, throttled by a shared token bucket.
+
+    Rate-limit (429) and timeout errors are retried with exponential backoff.
+    """
+
+    def __init__(self, backend, requests_per_second=REQUESTS_PER_SECOND, workers=WORKERS,
+                 max_retries=MAX_RETRIES, backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX):
+        self.backend = backend
+        self.bucket = TokenBucket(requests_per_second)
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def _call(self, method, *args, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                # Summed over all workers, so it can exceed the wall-clock time
+                with profiler.stage("geocoder requests"):
+                    return method(*args, **kwargs)
+            except GeocoderRateLimited as e:
+                profiler.count("geocoder_retries.rate_limited")
+                if attempt == self.max_retries:
+                    raise
+                delay = e.retry_after or self._backoff(attempt)
+                self.bucket.pause(delay)
+            except GeocoderTimedOut:
+                profiler.count("geocoder_retries.timed_out")
+                if attempt == self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+            time.sleep(delay)
+
+    def _backoff(self, attempt):
+        # Full jitter keeps the workers from retrying in lockstep
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def geocode(self, query, **kwargs):
+        return self._call(self.backend.geocode, query, **kwargs)
+
+    def reverse(self, point, **kwargs):
+        return self._call(self.backend.reverse, point, **kwargs)
+
+    def map(self, fn, items):
+        """Apply fn(*item) to every item on the worker pool, yielding (item, result) as they finish."""
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(fn, *item): item for item in items}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+
+# Shared engine, persistent cache and optional offline gazetteer used by lookup_location
+engine = GeocodingEngine(backend_from_env())
+geocode_cache = GeocodeCache()
+gazetteer = PostalGazetteer.open_if_available()
+
+# Function to change the throughput of the shared engine, e.g. for a self-hosted backend
+def configure_engine(requests_per_second=None, workers=None):
+    if requests_per_second is not None:
+        engine.bucket = TokenBucket(requests_per_second)
+    if workers is not None:
+        if workers < 1:
+            raise ValueError(f"Geocoding needs at least one worker, got {workers}")
+        engine.workers = workers
+
+def capital_query(country_code):
+    return f"capital city of {country_code}"
+
+
+class QueryMemo:
+    """Remembers the geocoder's answer to every query of one run, empty answers included.
+
+    Addresses of a run share many queries (the same postal code with differently
+    spelled cities, the capital of a country), so each is sent only once.
+    Workers asking for a query that is still in flight wait for its answer.
+    Errors are not remembered, so the next address retries the query.
+    """
+
+    def __init__(self):
+        self._answers = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(tier, query, country_code):
+        return tier, country_code.lower(), tuple(sorted(query.items())) if isinstance(query, dict) else query
+
+    def search(self, tier, query, country_code):
+        """Return the location found for a free-text or structured query within the country, or None."""
+        key = self._key(tier, query, country_code)
+        with self._lock:
+            answer = self._answers.get(key)
+            owner = answer is None
+            if owner:
+                answer = self._answers[key] = Future()
+
+        if not owner:
+            profiler.count("geocode_calls.memoized")
+            return answer.result()
+
+        profiler.count(f"geocode_calls.{tier}")
+        try:
+            location = engine.geocode(query, country_codes=country_code.lower())
+        except Exception as e:
+            with self._lock:
+                del self._answers[key]
+            answer.set_exception(e)
+            raise
+        answer.set_result(location)
+        return location
+
+
+# # Function to geocode based on country and postal code or city
+# def geocode_location_old_approach(country_code, postal_code=None, city=None):
+#     try:
+#         if postal_code:
+#             location = geolocator.geocode(f"{postal_code}, {country_code}")
+#             if location:
+#                 return location.latitude, location.longitude, postal_code, city, country_code
+            
+#             if city:
+#                 location = geolocator.geocode(f"{city}, {postal_code}, {country_code}")
+#                 if location:
+#                     return location.latitude, location.longitude, postal_code, city, country_code
+        
+#         if city:
+#             location = geolocator.geocode(f"{city}, {country_code}")
+#             if location:
+#                 return location.latitude, location.longitude, None, city, country_code
+        
+#         capital_location = geolocator.geocode(f"capital city of {country_code}")
+#         if capital_location:
+#             return capital_location.latitude, capital_location.longitude, None, None, country_code
+        
+#         return None, None, None, None, None
+#     except Exception as e:
+#         return None, None, None, None, None
+
+# Function to geocode based on country code, postal code, and city, served from the gazetteer or cache when possible.
+# Errors of the online lookup are raised, so callers can retry the address later.
+def lookup_location(country_code, postal_code=None, city=None, queries=None):
+    key = normalize_address(country_code, postal_code, city)
+
+    # The local gazetteer answers most postal code lookups without any network call
+    if gazetteer is not None:
+        found = gazetteer.lookup(*key)
+        if found is not None:
+            profiler.count("lookups.gazetteer")
+            return found
+
+    cached = geocode_cache.get(key)
+    if cached is not None:
+        profiler.count("lookups.cache")
+        return cached
+
+    try:
+        result = resolve_location(*key, queries=queries)
+    except Exception:
+        profiler.count("lookups.error")
+        raise
+
+    profiler.count("lookups.online")
+
+    geocode_cache.set(key, result)
+    return result
+
+# Function to geocode like lookup_location, with errors reported and returned as an empty result
+def geocode_location(country_code, postal_code=None, city=None, queries=None):
+    try:
+        return lookup_location(country_code, postal_code, city, queries=queries)
+    except Exception as e:
+        # Handle exceptions gracefully, but don't cache them as a confirmed miss
+        print(f"Geocoding error: {e}")
+        return EMPTY_RESULT
+
+# Function to geocode based on country code, postal code, and city, from the most specific query to the capital
+def resolve_location(country_code, postal_code=None, city=None, queries=None):
+    if not country_code:
+        return EMPTY_RESULT
+
+    # Queries already answered in this run, including the ones that found nothing
+    queries = queries if queries is not None else QueryMemo()
+
+    # Structured queries restricted to the country, so the server never answers from another one
+    tiers = [
+        ("city_postal", {'postalcode': postal_code, 'city': city}, (postal_code, city)),
+        ("postal", {'postalcode': postal_code}, (postal_code, None)),
+        ("city", {'city': city}, (None, city)),
+    ]
+    for tier, query, (result_postal_code, result_city) in tiers:
+        if all(query.values()):
+            location = queries.search(tier, query, country_code)
+            if location:
+                return location.latitude, location.longitude, result_postal_code, result_city, country_code
+
+    # If all else fails, geocode the capital city of the country, looked up once per country
+    capital_location = queries.search("capital", capital_query(country_code), country_code)
+    if capital_location:
+        return capital_location.latitude, capital_location.longitude, None, None, country_code
+
+    # Return None if no valid geocode results were found
+    return EMPTY_RESULT
+
+# Address column groups geocoded per scenario: (column suffix, latitude column, longitude column)
+GEOCODE_COLUMNS = {
+    "Standard visualization": [("", "latitude", "longitude")],
+    "Volume visualization": [("", "latitude", "longitude")],
+    "Supply-chain visualization": [("_dest", "latitude", "longitude"),
+                                   ("_warehouse", "warehouse_lat", "warehouse_lon")],
+    "Distance calculation": [("_orig", "orig_latitude", "orig_longitude"),
+                             ("_dest", "dest_latitude", "dest_longitude")],
+    "Nearest warehouse assignment": [("_dest", "latitude", "longitude"),
+                                     ("_warehouse", "warehouse_list_lat", "warehouse_list_lon")],
+}
+
+ADDRESS_FIELDS = ['country_code', 'postal_code', 'city']
+
+# Function to pull one address column group out of the frame under generic column names
+def address_columns(df, suffix):
+    addresses = pd.DataFrame(index=df.index)
+    for field in ADDRESS_FIELDS:
+        column = f"{field}{suffix}"
+        addresses[field] = df[column].astype(object) if column in df.columns else None
+    return addresses
+
+# Function to collect the address groups of the frame and the unique addresses across all of them
+def collect_addresses(df, column_groups):
+    groups = [address_columns(df, suffix) for suffix, _, _ in column_groups]
+
+    # Unique raw address tuples over all groups, each with its normalized key
+    unique_addresses = pd.concat(groups, ignore_index=True).drop_duplicates(ignore_index=True)
+    unique_addresses['key'] = [normalize_address(*address) for address in
+                               unique_addresses[ADDRESS_FIELDS].itertuples(index=False, name=None)]
+    return groups, unique_addresses
+
+# Function to join resolved coordinates (key -> (lat, lon)) back onto the rows of each address group
+def join_coordinates(df, groups, unique_addresses, column_groups, coordinates):
+    missing = (None, None)
+    unique_addresses = unique_addresses.assign(
+        lat=pd.to_numeric(unique_addresses['key'].map(lambda key: coordinates.get(key, missing)[0]), errors='coerce'),
+        lon=pd.to_numeric(unique_addresses['key'].map(lambda key: coordinates.get(key, missing)[1]), errors='coerce'),
+    )
+
+    for addresses, (_, lat_column, lon_column) in zip(groups, column_groups):
+        joined = addresses.merge(unique_addresses, how='left', on=ADDRESS_FIELDS)
+        df[lat_column] = joined['lat'].to_numpy(dtype=float)
+        df[lon_column] = joined['lon'].to_numpy(dtype=float)
+
+    return df
+
+# Function to geocode every address column group of the frame, looking up each unique address once
+def geocode_dataframe(df, column_groups, progress_callback=None):
+    groups, unique_addresses = collect_addresses(df, column_groups)
+    keys = unique_addresses['key'].drop_duplicates().tolist()
+
+    coordinates = {}
+    with profiler.stage("geocoding"):
+        lookup = partial(geocode_location, queries=QueryMemo())
+        for i, (key, (lat, lon, _, _, _)) in enumerate(engine.map(lookup, keys)):
+            coordinates[key] = (lat, lon)
+            if progress_callback:
+                progress_callback(i + 1, len(keys))
+
+    with profiler.stage("join coordinates"):
+        return join_coordinates(df, groups, unique_addresses, column_groups, coordinates)
@@ -0,0 +1,206 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from functools import partial
+
+from geocoding import engine, lookup_location, collect_addresses, join_coordinates, QueryMemo
+from profiling import profiler
+
+# Checkpoints of geocoding jobs, one SQLite file per job
+DEFAULT_JOBS_DIR = os.environ.get(
+    "GEOCODE_JOBS_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".geocode_jobs"),
+)
+JOB_TTL = 7 * 24 * 3600  # Checkpoints untouched for a week are removed
+COMMIT_EVERY = 25  # Results written to the checkpoint per transaction
+MAX_CONSECUTIVE_ERRORS = 20  # Failed lookups in a row after which a job stops, e.g. when the geocoder is down
+MAX_IDLE_JOBS = 4  # Jobs that are not running kept in memory; others are reloaded from their checkpoint
+
+
+# Function to derive a job id from the uploaded file's content hash and the scenario it is run with
+def job_id_for(upload_hash, scenario):
+    return hashlib.sha256(f"{upload_hash}:{scenario}".encode()).hexdigest()[:32]
+
+
+class GeocodingJob:
+    """Geocodes the unique addresses of a frame on a background thread, checkpointing every result.
+
+    A job created for an id whose checkpoint already exists resumes with the
+    addresses that are still missing. apply() returns the frame with the
+    coordinates resolved so far, so results can be shown before the job ends.
+    Addresses whose lookup failed are not checkpointed: they stay pending,
+    error says what went wrong, and starting the job again retries them.
+    """
+
+    def __init__(self, job_id, df, column_groups, jobs_dir=DEFAULT_JOBS_DIR):
+        self.job_id = job_id
+        self.column_groups = column_groups
+        self.groups, self.unique_addresses = collect_addresses(df, column_groups)
+        self.keys = self.unique_addresses['key'].drop_duplicates().tolist()
+        self.error = None
+
+        os.makedirs(jobs_dir, exist_ok=True)
+        self.path = os.path.join(jobs_dir, f"{job_id}.sqlite")
+        self._lock = threading.Lock()
+        self._thread = None
+        self._failed = 0
+        self._consecutive_failures = 0
+        self._last_error = None
+        self.coordinates = self._load_checkpoint()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS results (
+                country_code TEXT NOT NULL,
+                postal_code TEXT NOT NULL,
+                city TEXT NOT NULL,
+                latitude REAL,
+                longitude REAL,
+                PRIMARY KEY (country_code, postal_code, city)
+            )"""
+        )
+        return conn
+
+    def _load_checkpoint(self):
+        conn = self._connect()
+        rows = conn.execute("SELECT country_code, postal_code, city, latitude, longitude FROM results").fetchall()
+        conn.close()
+        return {tuple(part or None for part in row[:3]): (row[3], row[4]) for row in rows}
+
+    @property
+    def total(self):
+        return len(self.keys)
+
+    @property
+    def done(self):
+        with self._lock:
+            return len(self.coordinates)
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def finished(self):
+        return not self.running and self.done >= self.total
+
+    def start(self):
+        # Sessions clicking CREATE on the same upload at once must not start a second thread on one checkpoint
+        with self._lock:
+            if self.running or len(self.coordinates) >= self.total:
+                return
+            self.error = None
+            self._failed = self._consecutive_failures = 0
+            self._last_error = None
+            self._thread = threading.Thread(target=self._run, name=f"geocoding-job-{self.job_id}", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        with self._lock:
+            pending = [key for key in self.keys if key not in self.coordinates]
+
+        conn = self._connect()
+        try:
+            with profiler.stage("geocoding"):
+                self._geocode(conn, pending)
+        except Exception as e:
+            # Keep what we have; starting the job again resumes from the checkpoint
+            print(f"Geocoding job {self.job_id} failed: {e}")
+            self.error = e
+        finally:
+            conn.commit()
+            conn.close()
+
+    def _lookup(self, queries, *key):
+        # Once too many lookups in a row failed, the rest are skipped instead of failing one by one
+        with self._lock:
+            if self._consecutive_failures >= MAX_CONSECUTIVE_ERRORS:
+                return None
+        try:
+            result = lookup_location(*key, queries=queries)
+        except Exception as e:
+            with self._lock:
+                self._failed += 1
+                self._consecutive_failures += 1
+                self._last_error = e
+            return None
+        with self._lock:
+            self._consecutive_failures = 0
+        return result
+
+    def _geocode(self, conn, pending):
+        lookup = partial(self._lookup, QueryMemo())
+        written = 0
+        for key, result in engine.map(lookup, pending):
+            if result is None:
+                continue
+            lat, lon = result[:2]
+            with self._lock:
+                self.coordinates[key] = (lat, lon)
+            conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                         (*(part or "" for part in key), lat, lon))
+            written += 1
+            if written % COMMIT_EVERY == 0:
+                conn.commit()
+
+        if self._last_error is not None:
+            skipped = len(pending) - written - self._failed
+            self.error = (f"{self._failed} address(es) failed" + (f", {skipped} skipped" if skipped else "") +
+                          f", last error: {self._last_error}")
+
+    def apply(self, df):
+        """Fill the coordinate columns of df (the frame the job was created from) with the results so far."""
+        with self._lock:
+            coordinates = dict(self.coordinates)
+        with profiler.stage("join coordinates"):
+            return join_coordinates(df, self.groups, self.unique_addresses, self.column_groups, coordinates)
+
+
+# Jobs live at module level so they keep running across Streamlit reruns and sessions
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+# Function to drop the least recently used jobs that are not running beyond MAX_IDLE_JOBS; call with _jobs_lock held
+def _evict_idle_jobs():
+    idle = [job_id for job_id, job in _jobs.items() if not job.running]
+    for job_id in idle[:max(0, len(idle) - MAX_IDLE_JOBS)]:
+        del _jobs[job_id]
+
+
+# Function to get the job for an upload without starting it; a job no longer in memory is reloaded from its checkpoint
+def load_job(job_id, df, column_groups, jobs_dir=DEFAULT_JOBS_DIR):
+    with _jobs_lock:
+        job = _jobs.pop(job_id, None)
+        if job is None:
+            prune_checkpoints(jobs_dir)
+            job = GeocodingJob(job_id, df, column_groups, jobs_dir)
+        _jobs[job_id] = job  # Most recently used last
+        _evict_idle_jobs()
+    return job
+
+
+# Function to start (or resume) the geocoding job for an upload; an existing job is reused
+def start_job(job_id, df, column_groups, jobs_dir=DEFAULT_JOBS_DIR):
+    job = load_job(job_id, df, column_groups, jobs_dir)
+    job.start()
+    return job
+
+
+def get_job(job_id):
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+# Function to remove checkpoints that have not been touched for JOB_TTL
+def prune_checkpoints(jobs_dir=DEFAULT_JOBS_DIR):
+    if not os.path.isdir(jobs_dir):
+        return
+    cutoff = time.time() - JOB_TTL
+    for filename in os.listdir(jobs_dir):
+        path = os.path.join(jobs_dir, filename)
+        if filename.endswith(".sqlite") and os.path.getmtime(path) < cutoff:
+            os.remove(path)
@@ -0,0 +1,288 @@
+import folium
+import numpy as np
+from branca.element import MacroElement
+from folium.vector_layers import path_options
+from jinja2 import Template
+
+from tiles import tile_server, TileDataset, MAX_ZOOM
+
+COORDINATE_DECIMALS = 5  # About a metre, plenty for a dot on the map and much smaller HTML
+
+
+class CircleMarkerLayer(MacroElement):
+    """All circle markers of a map as one GeoJSON FeatureCollection drawn on a canvas renderer.
+
+    Instead of one JS object per folium.CircleMarker, the points travel as a
+    single data blob with the per-point radius and colors stored as feature
+    properties, so the HTML size and draw time grow only slightly per point.
+    """
+
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }}_renderer = L.canvas();
+            var {{ this.get_name() }} = L.geoJson(
+                {{ this.data|tojson }},
+                {
+                    pointToLayer: function (feature, latlng) {
+                        return L.circleMarker(latlng, Object.assign(
+                            {renderer: {{ this.get_name() }}_renderer},
+                            {{ this.style|tojson }},
+                            feature.properties
+                        ));
+                    }
+                }
+            ).addTo({{ this._parent.get_name() }});
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, lats, lons, radii, colors, fill_colors=None, fill_opacity=1.0):
+        super().__init__()
+        self._name = "CircleMarkerLayer"
+        self.style = {"fill": True, "fillOpacity": fill_opacity}
+
+        lats = np.round(np.asarray(lats, dtype=float), COORDINATE_DECIMALS)
+        lons = np.round(np.asarray(lons, dtype=float), COORDINATE_DECIMALS)
+        radii = np.broadcast_to(np.asarray(radii, dtype=float), lats.shape)
+        colors = np.broadcast_to(np.asarray(colors, dtype=object), lats.shape)
+        fill_colors = colors if fill_colors is None else np.broadcast_to(np.asarray(fill_colors, dtype=object), lats.shape)
+
+        self.data = {
+            "type": "FeatureCollection",
+            "features": [
+                {
+                    "type": "Feature",
+                    "geometry": {"type": "Point", "coordinates": [lon, lat]},
+                    "properties": {"radius": radius, "color": color, "fillColor": fill_color},
+                }
+                for lat, lon, radius, color, fill_color in zip(
+                    lats.tolist(), lons.tolist(), radii.tolist(), colors.tolist(), fill_colors.tolist())
+            ],
+        }
+
+
+class LineLayer(MacroElement):
+    """Straight line segments as one multi-polyline.
+
+    Works like a batched folium.PolyLine but skips folium's per-point
+    validation of the locations, which dominates for large segment arrays.
+    """
+
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = L.polyline(
+                {{ this.segments|tojson }},
+                {{ this.options|tojson }}
+            ).addTo({{ this._parent.get_name() }});
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, segments, **options):
+        super().__init__()
+        self._name = "LineLayer"
+        self.options = path_options(line=True, **options)
+        self.segments = np.round(np.asarray(segments, dtype=float), COORDINATE_DECIMALS).tolist()
+
+
+class GridCellLayer(MacroElement):
+    """Aggregated grid cells as one GeoJSON layer of rectangles on a canvas renderer.
+
+    Each cell carries its fill color and tooltip text as feature properties.
+    """
+
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = L.geoJson(
+                {{ this.data|tojson }},
+                {
+                    renderer: L.canvas(),
+                    style: function (feature) {
+                        return Object.assign({}, {{ this.style|tojson }}, {fillColor: feature.properties.fillColor});
+                    },
+                    onEachFeature: function (feature, layer) {
+                        layer.bindTooltip(feature.properties.tooltip);
+                    }
+                }
+            ).addTo({{ this._parent.get_name() }});
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, south, west, north, east, fill_colors, tooltips, fill_opacity=0.7, color="white", weight=0.5):
+        super().__init__()
+        self._name = "GridCellLayer"
+        self.style = {"color": color, "weight": weight, "fillOpacity": fill_opacity}
+        self.data = {
+            "type": "FeatureCollection",
+            "features": [
+                {
+                    "type": "Feature",
+                    "geometry": {"type": "Polygon", "coordinates": [[[w, s], [e, s], [e, n], [w, n], [w, s]]]},
+                    "properties": {"fillColor": fill_color, "tooltip": tooltip},
+                }
+                for s, w, n, e, fill_color, tooltip in zip(
+                    np.round(np.asarray(south, dtype=float), COORDINATE_DECIMALS).tolist(),
+                    np.round(np.asarray(west, dtype=float), COORDINATE_DECIMALS).tolist(),
+                    np.round(np.asarray(north, dtype=float), COORDINATE_DECIMALS).tolist(),
+                    np.round(np.asarray(east, dtype=float), COORDINATE_DECIMALS).tolist(),
+                    list(fill_colors), list(tooltips))
+            ],
+        }
+
+
+class TiledLayer(MacroElement):
+    """Points and lines loaded per viewport tile from the local tile server (see tiles.py).
+
+    Each tile is a canvas the features of its JSON tile are drawn onto, so
+    only the tiles in view at the current zoom are ever transferred or drawn.
+    When tiles fail to load, a message on the map says so.
+    """
+
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }}_error = L.control({position: 'topright'});
+            {{ this.get_name() }}_error.onAdd = function () {
+                var message = L.DomUtil.create('div');
+                message.style.cssText = 'background: white; color: #a00; border: 1px solid #a00; padding: 6px 8px; ' +
+                                        'max-width: 280px; font: 12px sans-serif;';
+                message.textContent = {{ this.error_message|tojson }};
+                return message;
+            };
+            var {{ this.get_name() }} = new (L.GridLayer.extend({
+                createTile: function (coords, done) {
+                    var tile = L.DomUtil.create('canvas', 'leaflet-tile');
+                    var size = this.getTileSize();
+                    tile.width = size.x;
+                    tile.height = size.y;
+                    fetch(L.Util.template({{ this.url|tojson }}, coords))
+                        .then(function (response) {
+                            if (!response.ok) {
+                                throw new Error('HTTP ' + response.status);
+                            }
+                            return response.json();
+                        })
+                        .then(function (data) {
+                            var context = tile.getContext('2d');
+                            var i;
+                            // Lines come as x1, y1, x2, y2, weight, sorted by weight
+                            context.strokeStyle = data.line_style.color;
+                            context.globalAlpha = data.line_style.opacity;
+                            for (i = 0; i < data.lines.length; i += 5) {
+                                if (i === 0 || data.lines[i + 4] !== data.lines[i - 1]) {
+                                    context.stroke();
+                                    context.lineWidth = data.lines[i + 4];
+                                    context.beginPath();
+                                }
+                                context.moveTo(data.lines[i], data.lines[i + 1]);
+                                context.lineTo(data.lines[i + 2], data.lines[i + 3]);
+                            }
+                            context.stroke();
+
+                            // Drawn like L.circleMarker: a 3px outline in the color, filled with the fill color
+                            context.lineWidth = 3;
+                            for (i = 0; i < data.points.length; i += 3) {
+                                var style = data.styles[data.points[i + 2]];
+                                context.beginPath();
+                                context.arc(data.points[i], data.points[i + 1], style[0], 0, 2 * Math.PI);
+                                context.globalAlpha = data.fill_opacity;
+                                context.fillStyle = style[2];
+                                context.fill();
+                                context.globalAlpha = 1;
+                                context.strokeStyle = style[1];
+                                context.stroke();
+                            }
+                            done(null, tile);
+                        })
+                        .catch(function (error) {
+                            // Shown once, however many tiles failed
+                            if (!{{ this.get_name() }}_error._map) {
+                                {{ this.get_name() }}_error.addTo({{ this._parent.get_name() }});
+                            }
+                            done(error, tile);
+                        });
+                    return tile;
+                }
+            }))({{ this.options|tojson }}).addTo({{ this._parent.get_name() }});
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, dataset, max_zoom=MAX_ZOOM):
+        super().__init__()
+        self._name = "TiledLayer"
+        self.dataset = dataset  # Kept, so a rendered map can register it again (see tiled_datasets)
+        self.url = tile_server.register(dataset)
+        self.options = {"maxZoom": max_zoom}
+        self.error_message = (f"Map tiles could not be loaded from {tile_server.url}. Set TILE_SERVER_URL to an "
+                              "address your browser can reach, or turn off tiled map rendering.")
+
+
+# Function to add circle markers to the map, either batched into one layer or as individual objects.
+# markers is a frame with lat, lon, radius and color columns and optionally fill_color.
+def add_circle_markers(map_object, markers, batched=True, fill_opacity=1.0):
+    if markers.empty:
+        return
+
+    markers = markers.assign(
+        lat=np.round(markers['lat'].to_numpy(dtype=float), COORDINATE_DECIMALS),
+        lon=np.round(markers['lon'].to_numpy(dtype=float), COORDINATE_DECIMALS),
+        fill_color=markers['fill_color'] if 'fill_color' in markers else markers['color'],
+    )
+    # Identical opaque dots stacked on one spot look like a single dot; keeping the last one keeps the paint order
+    if fill_opacity >= 1:
+        markers = markers.drop_duplicates(keep='last')
+
+    if batched:
+        CircleMarkerLayer(markers['lat'], markers['lon'], markers['radius'], markers['color'], markers['fill_color'],
+                          fill_opacity=fill_opacity).add_to(map_object)
+        return
+
+    for lat, lon, radius, color, fill_color in zip(markers['lat'].tolist(), markers['lon'].tolist(),
+                                                   markers['radius'].tolist(), markers['color'].tolist(),
+                                                   markers['fill_color'].tolist()):
+        folium.CircleMarker(
+            location=[lat, lon],
+            radius=radius,
+            color=color,
+            fill=True,
+            fill_color=fill_color,
+            fill_opacity=fill_opacity
+        ).add_to(map_object)
+
+
+# Function to add straight line segments to the map, either as one multi-polyline per line weight or one
+# PolyLine per segment; weights optionally gives every segment its own weight
+def add_lines(map_object, segments, batched=True, weights=None, **options):
+    if len(segments) == 0:
+        return
+
+    segments = np.asarray(segments, dtype=float)
+    weight = options.pop('weight', 3)  # Leaflet's default
+    weights = np.broadcast_to(np.asarray(weight if weights is None else weights, dtype=float), len(segments))
+
+    if batched:
+        for weight in np.unique(weights).tolist():
+            LineLayer(segments[weights == weight], weight=weight, **options).add_to(map_object)
+        return
+
+    for segment, weight in zip(np.round(segments, COORDINATE_DECIMALS).tolist(), weights.tolist()):
+        folium.PolyLine(locations=segment, weight=weight, **options).add_to(map_object)
+
+
+# Function to serve markers (and lines underneath them) from the local tile server instead of embedding them
+def add_tiled_layer(map_object, markers, lines=None, fill_opacity=1.0, line_weights=None, **line_style):
+    if markers.empty and (lines is None or len(lines) == 0):
+        return
+
+    dataset = TileDataset(markers, lines, fill_opacity=fill_opacity, line_style=line_style, line_weights=line_weights)
+    TiledLayer(dataset).add_to(map_object)
+
+
+# Function to list the tile datasets a map shows, to register them again when its rendered HTML is reused
+def tiled_datasets(map_object):
+    return [child.dataset for child in map_object._children.values() if isinstance(child, TiledLayer)]
@@ -1,166 +1,144 @@
 import streamlit as st
 import pandas as pd
-import folium
-from geopy.geocoders import Nominatim
-from geopy.distance import geodesic
 from io import BytesIO
-from datetime import datetime
-from streamlit_folium import folium_static
 import os
+import json
+from functools import partial
 from zipfile import ZipFile
-import streamlit.components.v1 as components
-
-# Initialize the geocoder
-geolocator = Nominatim(user_agent="streamlit")
-
-# # Function to geocode based on country and postal code or city
-# def geocode_location_old_approach(country_code, postal_code=None, city=None):
-#     try:
-#         if postal_code:
-#             location = geolocator.geocode(f"{postal_code}, {country_code}")
-#             if location:
-#                 return location.latitude, location.longitude, postal_code, city, country_code
-            
-#             if city:
-#                 location = geolocator.geocode(f"{city}, {postal_code}, {country_code}")
-#                 if location:
-#                     return location.latitude, location.longitude, postal_code, city, country_code
-        
-#         if city:
-#             location = geolocator.geocode(f"{city}, {country_code}")
-#             if location:
-#                 return location.latitude, location.longitude, None, city, country_code
-        
-#         capital_location = geolocator.geocode(f"capital city of {country_code}")
-#         if capital_location:
-#             return capital_location.latitude, capital_location.longitude, None, None, country_code
-        
-#         return None, None, None, None, None
-#     except Exception as e:
-#         return None, None, None, None, None
-
-# Function to geocode based on country code, postal code, and city with fallback to nearest location
-def geocode_location(country_code, postal_code=None, city=None):
-    try:
-        # Helper function to check if geocoded location is in the correct country
-        def is_in_correct_country(location, country_code):
-            if location and hasattr(location, 'raw'):
-                # Ensure the country code matches
-                address_details = location.raw.get('address', {})
-                return address_details.get('country_code', '').upper() == country_code.upper()
-            return False
-        
-        # Helper function to attempt nearest location reverse geocoding
-        def find_nearest_location(location):
-            if location:
-                # Attempt reverse geocoding near the found location
-                reverse_location = geolocator.reverse((location.latitude, location.longitude), exactly_one=True)
-                if reverse_location and is_in_correct_country(reverse_location, country_code):
-                    return reverse_location.latitude, reverse_location.longitude, postal_code, city, country_code
-            return None, None, None, None, None
-
-        # Try geocoding by city, postal code, and country (most specific)
-        if city and postal_code:
-            location = geolocator.geocode(f"{city}, {postal_code}, {country_code}")
-            if location and is_in_correct_country(location, country_code):
-                return location.latitude, location.longitude, postal_code, city, country_code
-            # Attempt nearest location if unsuccessful
-            nearest = find_nearest_location(location)
-            if nearest:
-                return nearest
-        
-        # Try geocoding by postal code and country
-        if postal_code:
-            location = geolocator.geocode(f"{postal_code}, {country_code}")
-            if location and is_in_correct_country(location, country_code):
-                return location.latitude, location.longitude, postal_code, None, country_code
-            # Attempt nearest location if unsuccessful
-            nearest = find_nearest_location(location)
-            if nearest:
-                return nearest
-        
-        # Try geocoding by city and country
-        if city:
-            location = geolocator.geocode(f"{city}, {country_code}")
-            if location and is_in_correct_country(location, country_code):
-                return location.latitude, location.longitude, None, city, country_code
-            # Attempt nearest location if unsuccessful
-            nearest = find_nearest_location(location)
-            if nearest:
-                return nearest
-        
-        # If all else fails, geocode the capital city of the country
-        capital_location = geolocator.geocode(f"capital city of {country_code}")
-        if capital_location and is_in_correct_country(capital_location, country_code):
-            return capital_location.latitude, capital_location.longitude, None, None, country_code
-        
-        # Return None if no valid geocode results were found
-        return None, None, None, None, None
-
-    except Exception as e:
-        # Handle exceptions gracefully
-        print(f"Geocoding error: {e}")
-        return None, None, None, None, None
-
-def save_to_excel(df, original_filename):
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=False, sheet_name='Geocoding Data')
-    output.seek(0)  # Important to reset the pointer to the start of the BytesIO buffer
-
-    current_date = datetime.now().strftime("%m%d%Y")
-    export_filename = f"{original_filename.split('.')[0]}_geocoding_details_{current_date}.xlsx"
-
-    return output, export_filename  # Return the BytesIO object itself, not getvalue()
-
-# Function to validate template columns
+import pipeline
+from pipeline import (TemplateError, read_sheets, content_hash, compute_distances, assign_nearest_warehouses,
+                      distance_matrix_csv, export_results, export_filename, source_label, add_source, combine_sources,
+                      SOURCE_COLUMN)
+from geocoding import geocode_cache, resolve_location, GEOCODE_COLUMNS, QueryMemo
+from binning import MIN_PRECISION, MAX_PRECISION
+from rendering import (new_map, render_html, plot_scenario, standalone_map_html, warehouse_colors, LAYER_COLORS,
+                       DEFAULT_COLOR, DOT_SIZE)
+from layers import tiled_datasets
+from tiles import tile_server
+from jobs import job_id_for, start_job, load_job, get_job
+from profiling import profiler
+from spatial_index import MAX_NEAREST
+
+TEMPLATES_FOLDER = os.path.join(os.path.dirname(__file__), 'templates')  # Path to the templates folder
+
+# Function to validate template columns, reporting missing columns (of the named source) in the app
 def validate_template(df, scenario):
-    if scenario == "Standard visualization":
-        required_columns = {'country_code', 'postal_code', 'city', 'layer'}
-    elif scenario == "Supply-chain visualization":
-        required_columns = {'country_code_warehouse', 'postal_code_warehouse', 'city_warehouse', 
-                            'country_code_dest', 'postal_code_dest', 'city_dest', 'layer'}
-    elif scenario == "Distance calculation":
-        required_columns = {'country_code_orig', 'postal_code_orig', 'city_orig','country_code_dest', 'postal_code_dest', 'city_dest'}
-    elif scenario == "Volume visualization":
-        required_columns = {'country_code', 'postal_code', 'city', 'volume'}
-    else:
-        return False
-    
-    missing_columns = required_columns - set(df.columns)
-    if missing_columns:
-        st.error(f"Uploaded file is missing columns: {', '.join(missing_columns)}")
+    try:
+        pipeline.validate_template(df, scenario)
+    except TemplateError as e:
+        st.error(str(e))
         return False
 
     return True
 
+# Function to parse an upload once per file content into {sheet name: frame}; reruns get a copy of the cached frames
+@st.cache_data(max_entries=16, show_spinner="Reading file...")
+def load_upload(upload_hash, name, _content):
+    with profiler.stage("read upload"):
+        return read_sheets(BytesIO(_content), name)
+
 # Function to create the map
 def create_map():
     if st.session_state.map is None:
-        initial_location = [20, 0]
-        st.session_state.map = folium.Map(location=initial_location, zoom_start=2)
+        st.session_state.map = new_map()
     
     return st.session_state.map
 
-def zip_templates_folder():
+# Function to fingerprint the template files by name, modification time and size
+def templates_signature():
+    signature = []
+    for filename in sorted(os.listdir(TEMPLATES_FOLDER)):
+        file_path = os.path.join(TEMPLATES_FOLDER, filename)
+        if os.path.isfile(file_path):
+            signature.append((filename, os.path.getmtime(file_path), os.path.getsize(file_path)))
+    return tuple(signature)
+
+# Function to zip the templates, built once per signature instead of on every rerun
+@st.cache_data(max_entries=1, show_spinner=False)
+def zip_templates_folder(signature):
     # Create a zip file in memory
     zip_buffer = BytesIO()
     with ZipFile(zip_buffer, 'w') as zip_file:
-        templates_folder = os.path.join(os.path.dirname(__file__), 'templates')  # Path to the templates folder
-        for filename in os.listdir(templates_folder):
-            file_path = os.path.join(templates_folder, filename)
-            if os.path.isfile(file_path):
-                zip_file.write(file_path, os.path.basename(file_path))  # Add file to zip
+        for filename, _, _ in signature:
+            file_path = os.path.join(TEMPLATES_FOLDER, filename)
+            zip_file.write(file_path, os.path.basename(file_path))  # Add file to zip
     zip_buffer.seek(0)  # Move to the start of the BytesIO buffer
     return zip_buffer.getvalue()
 
-def scale_dot_size(volume, min_volume, max_volume):
-    """Dynamically scale the dot size based on the volume value."""
-    min_size = 2  # Minimum dot size
-    max_size = 15  # Maximum dot size
-    if max_volume == min_volume:  # Prevent division by zero
-        return min_size
-    return min_size + (max_size - min_size) * ((volume - min_volume) / (max_volume - min_volume))
+# Fragment that polls a running geocoding job and reruns the whole app once it has stopped
+@st.fragment(run_every=2)
+def show_job_progress(job_id):
+    job = get_job(job_id)
+    if job.running:
+        st.progress(job.done / job.total, text=f"Geocoding unique addresses: {job.done} of {job.total}")
+    else:
+        st.rerun()
+
+# Function to plot the results on a fresh map and render its HTML; returns the HTML and the plotted layers
+def build_map(df, scenario, styling):
+    st.session_state.map = None
+    map_object = create_map()
+
+    with profiler.stage("prepare map layers"):
+        plotted_layers = plot_scenario(map_object, df, scenario, styling)
+
+    with profiler.stage("map HTML generation"):
+        html = render_html(map_object)
+    profiler.gauge("map_html_bytes", len(html.encode()))
+    return html, plotted_layers, tiled_datasets(map_object)
+
+# Function to get the rendered map of these results and styling; reruns from unrelated widgets reuse the last one
+def rendered_map(df, results_key, scenario, styling):
+    map_key = (results_key, scenario, json.dumps(styling, sort_keys=True, default=str))
+    cached = st.session_state.get('rendered_map')
+    if cached is not None and cached['key'] == map_key:
+        profiler.count("map_cache.hits")
+        # Other sessions may have pushed the tiles of this map out of the tile server since it was rendered
+        for dataset in cached['datasets']:
+            tile_server.register(dataset)
+    else:
+        html, plotted_layers, datasets = build_map(df, scenario, styling)
+        cached = st.session_state.rendered_map = {'key': map_key, 'html': html, 'layers': plotted_layers,
+                                                  'datasets': datasets}
+    return cached['html'], cached['layers']
+
+# Function to assign the nearest warehouses to these results; reruns from unrelated widgets reuse the last assignment
+def assigned_warehouses(df, results_key, count, method):
+    assignment_key = (results_key, count, method)
+    cached = st.session_state.get('warehouse_assignment')
+    if cached is not None and cached['key'] == assignment_key:
+        profiler.count("warehouse_assignment_cache.hits")
+        for column, values in cached['columns'].items():
+            df[column] = values
+        return df
+    with profiler.stage("nearest warehouses"):
+        assign_nearest_warehouses(df, count, method)
+    assigned_columns = [f'warehouse_{rank}{suffix}' for rank in range(1, count + 1) for suffix in ('', '_km')]
+    st.session_state.warehouse_assignment = {'key': assignment_key,
+                                             'columns': df[assigned_columns + ['warehouse_lat', 'warehouse_lon']]}
+    return df
+
+# Function to show rendered map HTML like folium_static does, recording the transfer time
+def show_map(html, width=700, height=500):
+    with profiler.stage("map transfer"):
+        st.iframe(html, height=height + 10, width=width)
+
+# Function to show the collected timings and counters in a collapsible panel
+def show_profile_panel():
+    snapshot = profiler.snapshot()
+    with st.expander("Performance profile"):
+        if snapshot['stages']:
+            st.write("Stage timings (seconds)")
+            st.dataframe(pd.DataFrame.from_dict(snapshot['stages'], orient='index').sort_values('total_seconds', ascending=False))
+        if snapshot['counters']:
+            st.write("Counters")
+            st.dataframe(pd.Series(snapshot['counters'], name='count').sort_index())
+        if snapshot['hit_rates']:
+            st.write("Address lookups answered by: " +
+                     ", ".join(f"{source} {rate:.0%}" for source, rate in sorted(snapshot['hit_rates'].items())))
+        if 'map_html_bytes' in snapshot['gauges']:
+            st.write(f"Rendered map HTML: {snapshot['gauges']['map_html_bytes'] / 1024:,.0f} KB")
+        st.download_button("Export profile as JSON", profiler.to_json(), file_name="profile.json", mime="application/json")
 
 # Streamlit app starts here
 st.set_page_config(page_title="Data Visualization Tool", layout="wide")
@@ -177,11 +155,7 @@ st.sidebar.markdown("<p style='text-align: center; font-size:10px; margin-top:-2
 
 # Initialize session state variables if they don't exist
 if 'layer_colors' not in st.session_state:
-    st.session_state.layer_colors = {
-        1: "#4D148C", 2: "#FF6200", 3: "#671CAA", 4: "#7D22C3", 5: "#932DA2", 6: "#A63685",
-        7: "#B83F6A", 8: "#C74755", 9: "#D87E88", 10: "#C172AA",
-        # Add more colors here #
-    }
+    st.session_state.layer_colors = dict(LAYER_COLORS)
 
 if 'map' not in st.session_state:
     st.session_state.map = None
@@ -191,23 +165,72 @@ if 'df' not in st.session_state:
 
 # Initialize dot size if it doesn't exist
 if 'dot_size' not in st.session_state:
-    st.session_state.dot_size = 2  # Set a default value for dot size
+    st.session_state.dot_size = DOT_SIZE  # Set a default value for dot size
 
 with st.sidebar:
     # Store the currently selected scenario
-    selected_scenario = st.selectbox("Select a scenario", ("Standard visualization","Volume visualization", "Supply-chain visualization", "Distance calculation"))
+    selected_scenario = st.selectbox("Select a scenario", pipeline.SCENARIOS)
 
     # Check if the scenario has changed
     if 'scenario' in st.session_state and st.session_state.scenario != selected_scenario:
         # Clear relevant session state data when the scenario changes
         st.session_state.map = None
         st.session_state.df = None
-        st.session_state.dot_size = 2  # Reset dot size if needed
+        st.session_state.dot_size = DOT_SIZE  # Reset dot size if needed
 
     # Store the current scenario
     st.session_state.scenario = selected_scenario
 
-    uploaded_file = st.file_uploader("Choose an Excel file", type="xlsx")
+    if selected_scenario in ("Distance calculation", "Nearest warehouse assignment"):
+        distance_method = st.selectbox("Distance method", ("haversine", "ellipsoidal"),
+                                       format_func=lambda method: {"haversine": "Haversine (fast)",
+                                                                   "ellipsoidal": "Ellipsoidal (exact)"}[method])
+    if selected_scenario == "Distance calculation":
+        export_distance_matrix = st.checkbox("Export full origin × destination matrix")
+
+    if selected_scenario == "Nearest warehouse assignment":
+        nearest_warehouses = st.number_input("Warehouses per destination", min_value=1, max_value=MAX_NEAREST,
+                                             value=1, help="Lists this many of the nearest warehouses for every "
+                                                           "destination, closest first.")
+
+    if selected_scenario == "Volume visualization":
+        volume_display = st.selectbox("Volume display", ("Dots per row", "Aggregated grid"),
+                                      help="Aggregated grid sums the volume per map cell, which stays fast and "
+                                           "readable for dense data.")
+        if volume_display == "Aggregated grid":
+            grid_precision = st.select_slider("Grid cell size (geohash precision)",
+                                              options=["Auto"] + list(range(MIN_PRECISION, MAX_PRECISION + 1)),
+                                              help="Auto picks the cell size from the map's zoom level. "
+                                                   "Higher numbers mean smaller cells.")
+
+    if selected_scenario in ("Supply-chain visualization", "Nearest warehouse assignment"):
+        flow_lines = st.selectbox("Flow lines", ("One line per lane", "Bundled by destination area"),
+                                  help="Lanes are drawn once per warehouse and destination, thicker for more "
+                                       "shipments. Bundling merges the lanes into each area into one trunk line, "
+                                       "which keeps dense networks readable.")
+
+    batched_rendering = st.checkbox("Batched map rendering", value=True,
+                                    help="Draw all points as one canvas layer instead of one object per point. "
+                                         "Much faster for large files.")
+    tiled_rendering = st.checkbox("Tiled map rendering", value=False,
+                                  help="Serve the points from a local tile server so the map only loads what is "
+                                       "in view. Keeps files with millions of rows interactive.")
+
+    export_format = st.selectbox("Export format", pipeline.OUTPUT_FORMATS,
+                                 format_func=lambda output_format: {"xlsx": "Excel", "csv": "CSV", "parquet": "Parquet",
+                                                                   "geojson": "GeoJSON"}[output_format],
+                                 help="Excel holds about a million rows at most; CSV and Parquet export large "
+                                      "results much faster.")
+    if selected_scenario != "Distance calculation":
+        include_map = st.checkbox("Include the map in the download (zip)",
+                                  help="Bundles the results with the map as a page that opens without the app.")
+    else:
+        include_map = False
+
+    uploaded_files = st.file_uploader("Choose Excel, CSV or Parquet files", type=["xlsx", "csv", "parquet"],
+                                      accept_multiple_files=True,
+                                      help="Every sheet of every file is geocoded together, so addresses they "
+                                           "share are looked up only once.")
     create_map_button = st.button("CREATE", key="create")
 
 col1, col2 = st.columns([1, 3])
@@ -215,126 +238,102 @@ col1, col2 = st.columns([1, 3])
 st.sidebar.markdown("<br>" * 3, unsafe_allow_html=True) # Make some space
 st.sidebar.download_button(
     label="Download templates",
-    data=zip_templates_folder(),
+    data=zip_templates_folder(templates_signature()),
     file_name="templates.zip",
     mime="application/zip"
 )
 
-if uploaded_file:
-    # Read the Excel file with proper handling for leading zeros in postal codes
-    dtype_mapping = {
-        'postal_code': str,
-        'postal_code_warehouse': str,
-        'postal_code_dest': str,
-        'country_code': str,
-        'country_code_warehouse': str,
-        'country_code_dest': str
-    }
-
-    df = pd.read_excel(uploaded_file, dtype=dtype_mapping)
+with st.sidebar.expander("Geocode cache"):
+    cache_stats = geocode_cache.stats()
+    st.write(f"Entries: {cache_stats['entries']} (misses: {cache_stats['misses']}, stale: {cache_stats['stale']})")
+    if st.button("Refresh stale entries", disabled=cache_stats['stale'] == 0):
+        refreshed = geocode_cache.refresh_stale(
+            partial(resolve_location, queries=QueryMemo()),
+            progress_callback=lambda done, total: progress_bar_container.progress(done / total)
+        )
+        progress_bar_container.empty()
+        st.write(f"Refreshed {refreshed} of {cache_stats['stale']} stale entries")
+
+if uploaded_files:
+    # Read the files with proper handling for leading zeros in postal codes, each parsed only once per upload
+    sources = {}
+    upload_hashes = []
+    for uploaded_file in uploaded_files:
+        upload_content = uploaded_file.getvalue()
+        upload_hashes.append(content_hash(upload_content))
+        sheets = load_upload(upload_hashes[-1], uploaded_file.name, upload_content)
+        for sheet, sheet_df in sheets.items():
+            add_source(sources, source_label(uploaded_file.name, sheet, len(sheets)), sheet_df)
+
+    # Sheets of a batch that don't match the template (notes, lookup tables) are left out, like the CLI does
+    if len(sources) > 1:
+        for label, source_df in list(sources.items()):
+            try:
+                pipeline.validate_template(source_df, selected_scenario)
+            except TemplateError as e:
+                st.warning(f"Skipped {label}: {e}")
+                del sources[label]
+
+    # All sources form one batch, tagged with the source of every row, so geocoding runs once over all of them
+    df = combine_sources(sources)
+    upload_hash = content_hash("".join(upload_hashes).encode())
+    export_name = uploaded_files[0].name if len(sources) == 1 else "batch"
     st.session_state.df = df
 
-    if create_map_button and validate_template(df, selected_scenario):
-        df['latitude'] = None
-        df['longitude'] = None
-
-        if selected_scenario == "Supply-chain visualization":
-            df['warehouse_lat'] = None
-            df['warehouse_lon'] = None
-
-        total_rows = len(df)
-
-        location_bounds = []  # List to store all coordinates for fitting map bounds
-
-        for index, row in df.iterrows():
-            if selected_scenario == "Standard visualization":
-                country_code = row['country_code']
-                postal_code = row.get('postal_code')
-                city = row.get('city')
-
-                lat, lon, _, _, _ = geocode_location(country_code, postal_code, city)
-                df.at[index, 'latitude'] = lat
-                df.at[index, 'longitude'] = lon
-
-                if lat is not None and lon is not None:
-                    location_bounds.append([lat, lon])
-
-            elif selected_scenario == "Volume visualization":
-                # Find min and max volume for smart scaling
-                min_volume = df['volume'].min()
-                max_volume = df['volume'].max()
-
-                country_code = row['country_code']
-                postal_code = row.get('postal_code')
-                city = row.get('city')
-
-                lat, lon, _, _, _ = geocode_location(country_code, postal_code, city)
-                df.at[index, 'latitude'] = lat
-                df.at[index, 'longitude'] = lon
-
-                if lat is not None and lon is not None:
-                    location_bounds.append([lat, lon])
-
-            elif selected_scenario == "Supply-chain visualization":
-                country_code_dest = row['country_code_dest']
-                postal_code_dest = row.get('postal_code_dest')
-                city_dest = row.get('city_dest')
-
-                lat, lon, _, _, _ = geocode_location(country_code_dest, postal_code_dest, city_dest)
-                df.at[index, 'latitude'] = lat
-                df.at[index, 'longitude'] = lon
-
-                country_code_warehouse = row['country_code_warehouse']
-                postal_code_warehouse = row.get('postal_code_warehouse')
-                city_warehouse = row.get('city_warehouse')
-
-                warehouse_lat, warehouse_lon, _, _, _ = geocode_location(country_code_warehouse, postal_code_warehouse, city_warehouse)
-                df.at[index, 'warehouse_lat'] = warehouse_lat
-                df.at[index, 'warehouse_lon'] = warehouse_lon
-
-                if warehouse_lat is not None and warehouse_lon is not None:
-                    location_bounds.append([warehouse_lat, warehouse_lon])
-
-            progress = (index + 1) / total_rows
-            progress_bar_container.progress(progress)
+    # Geocoding runs as a checkpointed background job keyed by the file contents, so it
+    # survives reruns and disconnects and resumes where it stopped
+    job_id = job_id_for(upload_hash, selected_scenario)
+
+    if create_map_button and not sources:
+        st.error("None of the uploaded files or sheets match the template of this scenario.")
+    elif create_map_button and all([validate_template(source_df, selected_scenario) for source_df in sources.values()]):
+        st.session_state.job_id = job_id
+        profiler.reset()
+        start_job(job_id, df, GEOCODE_COLUMNS[selected_scenario])
+
+    # A job dropped from memory since is reloaded from its checkpoint, without starting it again
+    job = (load_job(job_id, df, GEOCODE_COLUMNS[selected_scenario])
+           if st.session_state.get('job_id') == job_id else None)
+    show_results = job is not None and job.finished
+
+    if job is not None and not job.finished:
+        if job.running:
+            show_job_progress(job_id)
+            show_results = st.checkbox("Show finished rows while geocoding continues")
+        else:
+            st.error(f"Geocoding stopped early ({job.error}). Click CREATE to resume from the last checkpoint.")
+            show_results = True
+
+    if show_results:
+        df = job.apply(df)
 
         st.session_state.df = df
 
-        # Create and plot on the map
-        map_object = create_map()
+        if selected_scenario == "Nearest warehouse assignment":
+            assigned_warehouses(df, (upload_hash, job.done), nearest_warehouses, distance_method)
+
+        # Plot on a fresh map only when the results or the styling changed since the last rerun
+        if selected_scenario != "Distance calculation":
+            styling = {
+                'layer_colors': (warehouse_colors(df['warehouse_1'].dropna())
+                                 if selected_scenario == "Nearest warehouse assignment" else st.session_state.layer_colors),
+                'dot_size': st.session_state.dot_size,
+                'batched': batched_rendering,
+                'tiled': tiled_rendering,
+                'volume_display': volume_display if selected_scenario == "Volume visualization" else None,
+                'grid_precision': grid_precision if (selected_scenario == "Volume visualization" and
+                                                     volume_display == "Aggregated grid") else "Auto",
+                'flow_lines': flow_lines if selected_scenario in ("Supply-chain visualization",
+                                                                  "Nearest warehouse assignment") else None,
+            }
+            map_html, plotted_layers = rendered_map(df, (upload_hash, job.done), selected_scenario, styling)
 
         # Inside your "Standard visualization" scenario
         if selected_scenario == "Standard visualization":
-            plotted_layers = set()  # Track plotted layers
-
-            for index, row in df.iterrows():
-                lat = row['latitude']
-                lon = row['longitude']
-                layer = row['layer']
-
-                if lat and lon:
-                    color = st.session_state.layer_colors.get(layer, "#808080")
-                    folium.CircleMarker(
-                        location=[lat, lon],
-                        radius=st.session_state.dot_size,
-                        color=color,
-                        fill=True,
-                        fill_color=color,
-                        fill_opacity=1.0
-                    ).add_to(map_object)
-                    location_bounds.append([lat, lon])  # Add to bounds for zoom
-
-                    # Add the layer to the set of plotted layers
-                    plotted_layers.add(layer)
-
-            # Fit the map to the bounds of all plotted locations
-            if location_bounds:
-                map_object.fit_bounds(location_bounds)
-
             # Render the map on the left side
             col1, col2 = st.columns([2, 1])
             with col1:
-                folium_static(map_object)
+                show_map(map_html)
 
             # Define the legend HTML outside the map and display it on the right
             with col2:
@@ -345,105 +344,29 @@ if uploaded_file:
 
                 # Append each plotted layer and its color to the HTML string
                 for layer in plotted_layers:
-                    color = st.session_state.layer_colors.get(layer, "#808080")
+                    color = st.session_state.layer_colors.get(layer, DEFAULT_COLOR)
                     legend_html += f"<div style='margin-bottom: 1px;'><span style='background-color:{color}; width: 10px; height: 10px; border-radius: 50%; display: inline-block; margin-right: 1px;'></span>  {layer} day(s)</div>"
 
                 legend_html += "</div>"
 
                 # Render the legend HTML in the right column
-                components.html(legend_html, height=150 + len(plotted_layers) * 20)  # Adjust height dynamically
+                st.iframe(legend_html, height=150 + len(plotted_layers) * 20)  # Adjust height dynamically
 
             progress_bar_container.empty()
 
         if selected_scenario == "Volume visualization":
-                    plotted_layers = set()  # Track plotted layers
-
-                    for index, row in df.iterrows():
-                        lat = row['latitude']
-                        lon = row['longitude']
-                        volume = row['volume']
-
-                        if lat and lon:
-                            color = st.session_state.layer_colors.get(volume, "#808080")
-                            size = scale_dot_size(volume, min_volume, max_volume)
-                            folium.CircleMarker(
-                                location=[lat, lon],
-                                radius=size,
-                                color=color,
-                                fill=True,
-                                fill_color="808080",
-                                fill_opacity=1.0
-                            ).add_to(map_object)
-                            location_bounds.append([lat, lon])  # Add to bounds for zoom
-
-                            # Add the layer to the set of plotted layers
-                            plotted_layers.add(volume)
-
-                    # Fit the map to the bounds of all plotted locations
-                    if location_bounds:
-                        map_object.fit_bounds(location_bounds)
-
                     # Render the map on the left side
                     col1, col2 = st.columns([2, 1])
                     with col1:
-                        folium_static(map_object)
+                        show_map(map_html)
 
                     progress_bar_container.empty()
 
         elif selected_scenario == "Supply-chain visualization":
-            plotted_layers = set()  # Track plotted layers
-            location_bounds = []  # Initialize location bounds
-
-            for index, row in df.iterrows():
-                warehouse_lat = row['warehouse_lat']
-                warehouse_lon = row['warehouse_lon']
-                lat = row['latitude']
-                lon = row['longitude']
-                layer = row['layer']
-
-                # Plot the warehouse marker
-                if warehouse_lat and warehouse_lon:
-                    folium.CircleMarker(
-                        location=[warehouse_lat, warehouse_lon],
-                        radius=st.session_state.dot_size * 1.5,
-                        color='yellow',
-                        fill=True,
-                        fill_color='yellow',
-                        fill_opacity=1.0
-                    ).add_to(map_object)
-                    location_bounds.append([warehouse_lat, warehouse_lon])
-
-                # Plot the regular location markers
-                if lat and lon:
-                    color = st.session_state.layer_colors.get(layer, "#808080")
-                    folium.CircleMarker(
-                        location=[lat, lon],
-                        radius=st.session_state.dot_size,
-                        color=color,
-                        fill=True,
-                        fill_color=color,
-                        fill_opacity=1.0
-                    ).add_to(map_object)
-                    location_bounds.append([lat, lon])  # Add to bounds for zoom
-
-                # Add lines connecting warehouse to destination
-                if warehouse_lat and warehouse_lon and lat and lon:
-                    folium.PolyLine(
-                        locations=[[warehouse_lat, warehouse_lon], [lat, lon]],
-                        color='grey', weight=0.5, opacity=1
-                    ).add_to(map_object)
-
-                    # Add the layer to the set of plotted layers
-                    plotted_layers.add(layer)
-
-            # Fit the map to the bounds of all plotted locations
-            if location_bounds:
-                map_object.fit_bounds(location_bounds)
-
             # Render the map on the left side
             col1, col2 = st.columns([2, 1])
             with col1:
-                folium_static(map_object)
+                show_map(map_html)
 
             # Define the legend HTML outside the map and display it on the right
             with col2:
@@ -458,64 +381,91 @@ if uploaded_file:
 
                 # Append each plotted layer and its color to the HTML string
                 for layer in plotted_layers:
-                    color = st.session_state.layer_colors.get(layer, "#808080")
+                    color = st.session_state.layer_colors.get(layer, DEFAULT_COLOR)
                     legend_html += f"<div style='margin-bottom: 1px;'><span style='background-color:{color}; width: 10px; height: 10px; border-radius: 50%; display: inline-block; margin-right: 1px;'></span>  {layer} day(s)</div>"
 
                 legend_html += "</div>"
 
                 # Render the legend HTML in the right column
-                components.html(legend_html, height=150 + len(plotted_layers) * 20)  # Adjust height dynamically
+                st.iframe(legend_html, height=150 + len(plotted_layers) * 20)  # Adjust height dynamically
 
             progress_bar_container.empty()
 
         elif selected_scenario == "Distance calculation":
+            # Calculate the distance where both origin and destination are available, in whole km
+            with profiler.stage("distances"):
+                compute_distances(df, distance_method)
+
+            # Display the results in Streamlit
+            st.dataframe(df[([SOURCE_COLUMN] if len(sources) > 1 else []) +
+                            ['country_code_orig', 'postal_code_orig', 'city_orig',
+                             'country_code_dest', 'postal_code_dest', 'city_dest',
+                             'distance_km']])
+
+            # The matrix grows with origins x destinations, so it is only built once the button is clicked
+            if export_distance_matrix:
+                st.download_button(label="Download distance matrix",
+                                   data=partial(distance_matrix_csv, df, distance_method),
+                                   file_name=f"{export_name.split('.')[0]}_distance_matrix.csv.gz",
+                                   mime="application/gzip", on_click="ignore")
+
+        elif selected_scenario == "Nearest warehouse assignment":
+            # Render the map on the left side
+            col1, col2 = st.columns([2, 1])
+            with col1:
+                show_map(map_html)
 
-            if 'latitude' not in df.columns or 'longitude' not in df.columns:
-                df['orig_latitude'] = None
-                df['orig_longitude'] = None
-                df['dest_latitude'] = None
-                df['dest_longitude'] = None
-
-        df['distance_km'] = None
-
-        total_rows = len(df)
-
-        for index, row in df.iterrows():
-
-            # Geocode the origin
-            country_code_orig = row['country_code_orig']
-            postal_code_orig = row.get('postal_code_orig')
-            city_orig = row.get('city_orig')
-
-            orig_lat, orig_lon, _, _, _ = geocode_location(country_code_orig, postal_code_orig, city_orig)
-            df.at[index, 'orig_latitude'] = orig_lat
-            df.at[index, 'orig_longitude'] = orig_lon
+            # Legend with the color of every warehouse that serves a destination
+            with col2:
+                legend_html = """
+                    <div style='border:1px solid grey; padding: 1px; border-radius: 1px; background-color:black; width: 150px; font-family: "Inter", sans-serif; color: white; font-size: 13px;'>
+                    <h4>LEGEND</h4>
+                    <div style='margin-bottom: 1px;'>
+                        <span style='background-color:yellow; width: 10px; height: 10px; border-radius: 50%; display: inline-block; margin-right: 1px;'></span>
+                        Warehouse
+                    </div>
+                """
 
-            # Geocode the destination
-            country_code_dest = row['country_code_dest']
-            postal_code_dest = row.get('postal_code_dest')
-            city_dest = row.get('city_dest')
+                for warehouse in sorted(plotted_layers):
+                    color = styling['layer_colors'].get(warehouse, DEFAULT_COLOR)
+                    legend_html += f"<div style='margin-bottom: 1px;'><span style='background-color:{color}; width: 10px; height: 10px; border-radius: 50%; display: inline-block; margin-right: 1px;'></span>  {warehouse}</div>"
 
-            dest_lat, dest_lon, _, _, _ = geocode_location(country_code_dest, postal_code_dest, city_dest)
-            df.at[index, 'dest_latitude'] = dest_lat
-            df.at[index, 'dest_longitude'] = dest_lon
+                legend_html += "</div>"
 
-            # Calculate the distance if both origin and destination are available
-            if orig_lat and orig_lon and dest_lat and dest_lon:
-                distance = geodesic((orig_lat, orig_lon), (dest_lat, dest_lon)).kilometers
-                df.at[index, 'distance_km'] = int(distance)  # Convert to integer to remove decimal points
+                st.iframe(legend_html, height=150 + len(plotted_layers) * 20)  # Adjust height dynamically
 
-            # Update the progress bar
-            progress_bar_container.progress(progress)
+            # The nearest warehouses of every destination, closest first
+            nearest_columns = [column for rank in range(1, nearest_warehouses + 1)
+                               for column in (f'warehouse_{rank}', f'warehouse_{rank}_km')]
+            st.dataframe(df[([SOURCE_COLUMN] if len(sources) > 1 else []) +
+                            ['country_code_dest', 'postal_code_dest', 'city_dest'] + nearest_columns])
 
-        # Display the results in Streamlit
-        st.dataframe(df[['country_code_orig', 'postal_code_orig', 'city_orig',
-                     'country_code_dest', 'postal_code_dest', 'city_dest',
-                     'distance_km']])
+            progress_bar_container.empty()
 
-        # Enable users to download the results as an Excel file
-        result_data, result_filename = save_to_excel(df, uploaded_file.name)
-        st.download_button(label="Download raw data", data=result_data, file_name=result_filename, mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+        # Enable users to download the results, with a sheet per source for a batch in Excel. The file (and the
+        # map page, when included) is only written once the download button is clicked.
+        if export_format == 'xlsx' and len(df) > pipeline.EXCEL_MAX_ROWS:
+            st.warning(f"{len(df):,} rows don't fit in an Excel sheet; choose CSV or Parquet to export them.")
+        else:
+            results_df = df if len(sources) > 1 else df.drop(columns=SOURCE_COLUMN)
+
+            def download_data():
+                bundled_map = None
+                if include_map:
+                    # Tiles come from this app's tile server, so a tiled map is rendered again with embedded points
+                    bundled_map = standalone_map_html(df, selected_scenario, styling) if tiled_rendering else map_html
+                return export_results(results_df, export_name, export_format, map_html=bundled_map,
+                                      by_source=len(sources) > 1)
+
+            st.download_button(
+                label="Download raw data",
+                data=download_data,
+                file_name=export_filename(export_name, export_format, map_included=include_map),
+                mime=pipeline.MIME_TYPES['zip' if include_map else export_format],
+                on_click="ignore"
+            )
 
         # Clean the progress bars in the end
         progress_bar_container.empty()
+
+    show_profile_panel()
@@ -0,0 +1,414 @@
+import gzip
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+from contextlib import nullcontext
+from datetime import datetime
+from io import BytesIO
+from zipfile import ZipFile, ZIP_DEFLATED
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from openpyxl import load_workbook
+
+from distance import paired_distances_km, write_distance_matrix_csv
+from geocoding import address_columns, geocode_dataframe, GEOCODE_COLUMNS
+from profiling import profiler
+from spatial_index import SphereTree
+
+SCENARIOS = ("Standard visualization", "Volume visualization", "Supply-chain visualization", "Distance calculation",
+             "Nearest warehouse assignment")
+
+# Columns each scenario's template must contain
+REQUIRED_COLUMNS = {
+    "Standard visualization": {'country_code', 'postal_code', 'city', 'layer'},
+    "Supply-chain visualization": {'country_code_warehouse', 'postal_code_warehouse', 'city_warehouse',
+                                   'country_code_dest', 'postal_code_dest', 'city_dest', 'layer'},
+    "Distance calculation": {'country_code_orig', 'postal_code_orig', 'city_orig',
+                             'country_code_dest', 'postal_code_dest', 'city_dest'},
+    "Volume visualization": {'country_code', 'postal_code', 'city', 'volume'},
+    "Nearest warehouse assignment": {'country_code_warehouse', 'postal_code_warehouse', 'city_warehouse',
+                                     'country_code_dest', 'postal_code_dest', 'city_dest'},
+}
+
+# Read codes as text to keep the leading zeros in postal codes
+DTYPE_MAPPING = {
+    'postal_code': str,
+    'postal_code_warehouse': str,
+    'postal_code_dest': str,
+    'postal_code_orig': str,
+    'country_code': str,
+    'country_code_warehouse': str,
+    'country_code_dest': str,
+    'country_code_orig': str
+}
+
+CHUNK_ROWS = 50_000  # Rows parsed per chunk when streaming input files
+SOURCE_COLUMN = 'source'  # File (and sheet) each row of a combined batch came from
+MAX_SHEET_NAME = 31  # Excel's limit on sheet name length
+
+INPUT_EXTENSIONS = ('.xlsx', '.csv', '.parquet')
+OUTPUT_FORMATS = ('xlsx', 'csv', 'parquet', 'geojson')
+MIME_TYPES = {
+    'xlsx': "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    'csv': "text/csv",
+    'parquet': "application/vnd.apache.parquet",
+    'geojson': "application/geo+json",
+    'zip': "application/zip",
+}
+
+EXPORT_CHUNK_ROWS = 100_000  # Rows encoded at a time when writing csv, parquet or GeoJSON
+EXCEL_MAX_ROWS = 1_048_575  # Rows an xlsx sheet holds below its header
+GEOJSON_DECIMALS = 6  # About 10 cm
+# Coordinate columns of the scenarios, in the order a GeoJSON line runs through them
+GEOMETRY_COLUMNS = (('warehouse_lat', 'warehouse_lon'), ('orig_latitude', 'orig_longitude'),
+                    ('latitude', 'longitude'), ('dest_latitude', 'dest_longitude'))
+
+
+class TemplateError(ValueError):
+    pass
+
+
+# Function to validate template columns, raising TemplateError when the file doesn't match the scenario
+def validate_template(df, scenario):
+    if scenario not in REQUIRED_COLUMNS:
+        raise TemplateError(f"Unknown scenario: {scenario}")
+
+    missing_columns = REQUIRED_COLUMNS[scenario] - set(df.columns)
+    if missing_columns:
+        raise TemplateError(f"Uploaded file is missing columns: {', '.join(sorted(missing_columns))}")
+
+# Function to fingerprint uploaded file content, used to cache parsed frames and key geocoding jobs
+def content_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+def _code_text(value):
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    # Excel stores numeric codes as floats, 10115.0 should read as "10115"
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+# Function to turn the code columns of a chunk into text, like reading them with dtype=str
+def _codes_as_text(chunk):
+    for column in DTYPE_MAPPING.keys() & set(chunk.columns):
+        chunk[column] = chunk[column].astype(object).map(_code_text)
+    return chunk
+
+def _xlsx_chunks(source, chunk_rows, sheet=None):
+    # Read-only mode streams the rows of the sheet instead of loading the whole workbook
+    workbook = load_workbook(source, read_only=True, data_only=True)
+    try:
+        worksheet = workbook.worksheets[0] if sheet is None else workbook[sheet]
+        rows = worksheet.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [f"Unnamed: {i}" if name is None else str(name) for i, name in enumerate(header)]
+
+        batch = []
+        yielded = False
+        for row in rows:
+            if all(value is None for value in row):
+                continue
+            batch.append(row[:len(columns)])
+            if len(batch) >= chunk_rows:
+                yield pd.DataFrame.from_records(batch, columns=columns).infer_objects()
+                batch = []
+                yielded = True
+        if batch or not yielded:
+            yield pd.DataFrame.from_records(batch, columns=columns).infer_objects()
+    finally:
+        workbook.close()
+
+def _parquet_chunks(source, chunk_rows):
+    for batch in pq.ParquetFile(source).iter_batches(batch_size=chunk_rows):
+        yield batch.to_pandas()
+
+def _extension(source, name=None):
+    name = name or getattr(source, 'name', None) or str(source)
+    return name, os.path.splitext(name)[1].lower()
+
+# Function to stream an input table from a path or named file-like object in chunks of rows;
+# sheet picks a worksheet of an xlsx file other than the first
+def iter_table_chunks(source, name=None, chunk_rows=CHUNK_ROWS, sheet=None):
+    name, extension = _extension(source, name)
+    if extension == '.xlsx':
+        chunks = _xlsx_chunks(source, chunk_rows, sheet)
+    elif extension == '.csv':
+        chunks = pd.read_csv(source, dtype=DTYPE_MAPPING, chunksize=chunk_rows)
+    elif extension == '.parquet':
+        chunks = _parquet_chunks(source, chunk_rows)
+    else:
+        raise ValueError(f"Unsupported file type: {name}")
+
+    for chunk in chunks:
+        yield _codes_as_text(chunk)
+
+# Function to read a whole input table from a path or named file-like object
+def read_table(source, name=None, chunk_rows=CHUNK_ROWS, sheet=None):
+    chunks = list(iter_table_chunks(source, name, chunk_rows, sheet))
+    if not chunks:
+        return pd.DataFrame()
+    return pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+
+# Function to read every non-empty sheet of an input file as {sheet name: frame}; csv and parquet files
+# have a single sheet named None
+def read_sheets(source, name=None, chunk_rows=CHUNK_ROWS):
+    name, extension = _extension(source, name)
+    if extension != '.xlsx':
+        return {None: read_table(source, name, chunk_rows)}
+
+    workbook = load_workbook(source, read_only=True)
+    sheets = workbook.sheetnames
+    workbook.close()
+    frames = {sheet: read_table(source, name, chunk_rows, sheet) for sheet in sheets}
+    return {sheet: df for sheet, df in frames.items() if not df.empty} or {sheets[0]: frames[sheets[0]]}
+
+# Function to name a source by its file name, plus the sheet name for workbooks with several sheets
+def source_label(name, sheet=None, sheet_count=1):
+    label = os.path.basename(name)
+    return f"{label} [{sheet}]" if sheet is not None and sheet_count > 1 else label
+
+# Function to add a frame to a batch ({source label: frame}); sources with the same name get a numbered label
+def add_source(sources, label, df):
+    if label in sources:
+        label = f"{label} ({len(sources) + 1})"
+    sources[label] = df
+    return label
+
+# Function to stack the frames of a batch ({source label: frame}) into one, tagging every row with its source
+def combine_sources(frames):
+    if not frames:
+        return pd.DataFrame(columns=[SOURCE_COLUMN])
+    return pd.concat([df.assign(**{SOURCE_COLUMN: label}) for label, df in frames.items()], ignore_index=True)
+
+# Function to split combined results back into {source label: frame}, in batch order
+def split_by_source(df):
+    return {label: part.drop(columns=SOURCE_COLUMN).reset_index(drop=True)
+            for label, part in df.groupby(SOURCE_COLUMN, sort=False)}
+
+# Function to list the input files of a path, which may be a single file or a directory
+def input_files(path):
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, filename) for filename in os.listdir(path)
+                      if filename.lower().endswith(INPUT_EXTENSIONS) and not filename.startswith('~$'))
+    return [path]
+
+# Function to geocode all address columns the scenario uses
+def geocode(df, scenario, progress_callback=None):
+    return geocode_dataframe(df, GEOCODE_COLUMNS[scenario], progress_callback=progress_callback)
+
+# Function to add the origin to destination distance in whole km
+def compute_distances(df, method="haversine"):
+    distances = paired_distances_km(df['orig_latitude'], df['orig_longitude'],
+                                    df['dest_latitude'], df['dest_longitude'], method=method)
+    df['distance_km'] = pd.Series(np.floor(distances), index=df.index).astype('Int64')
+    return df
+
+# Function to list the nearest warehouses of every destination row, closest first, with their distance in whole km.
+# The warehouses are the geocoded addresses of the warehouse columns, a list that may be shorter than the
+# destinations; warehouse_lat and warehouse_lon get the closest one, for the map.
+def assign_nearest_warehouses(df, count=1, method="haversine"):
+    # Each source of a batch has its own warehouse list, so destinations are only assigned within their source
+    groups = (df.groupby(SOURCE_COLUMN, sort=False, dropna=False).indices if SOURCE_COLUMN in df
+              else {None: np.arange(len(df))})
+    labels = np.full((len(df), count), None, dtype=object)
+    lats = np.full((len(df), count), np.nan)
+    lons = np.full((len(df), count), np.nan)
+    for rows in groups.values():
+        group = df.iloc[rows]
+        warehouses = matrix_locations(group, '_warehouse', 'warehouse_list_lat', 'warehouse_list_lon')
+        # Index -1 (no warehouse found) picks the trailing empty entry
+        nearest, _ = SphereTree(warehouses['lat'], warehouses['lon']).query(group['latitude'], group['longitude'],
+                                                                             k=count)
+        labels[rows] = np.append(warehouses['label'].to_numpy(dtype=object), None)[nearest]
+        lats[rows] = np.append(warehouses['lat'].to_numpy(dtype=float), np.nan)[nearest]
+        lons[rows] = np.append(warehouses['lon'].to_numpy(dtype=float), np.nan)[nearest]
+
+    for rank in range(count):
+        distances = paired_distances_km(df['latitude'], df['longitude'], lats[:, rank], lons[:, rank], method=method)
+        df[f'warehouse_{rank + 1}'] = labels[:, rank]
+        df[f'warehouse_{rank + 1}_km'] = pd.Series(np.floor(distances), index=df.index).astype('Int64')
+    df['warehouse_lat'] = lats[:, 0]
+    df['warehouse_lon'] = lons[:, 0]
+    return df
+
+# Function to run the whole pipeline on one frame: validation, geocoding and distances
+def process(df, scenario, distance_method="haversine", progress_callback=None, nearest_warehouses=1):
+    validate_template(df, scenario)
+    geocode(df, scenario, progress_callback=progress_callback)
+    if scenario == "Distance calculation":
+        with profiler.stage("distances"):
+            compute_distances(df, distance_method)
+    elif scenario == "Nearest warehouse assignment":
+        with profiler.stage("nearest warehouses"):
+            assign_nearest_warehouses(df, nearest_warehouses, distance_method)
+    return df
+
+# Function to collect the unique geocoded locations of one address group, labelled for the matrix export
+def matrix_locations(df, suffix, lat_column, lon_column):
+    locations = address_columns(df, suffix).astype('string').fillna('')
+    locations['label'] = locations['country_code'].str.cat([locations['postal_code'], locations['city']], sep=' ').str.split().str.join(' ')
+    locations['lat'] = df[lat_column]
+    locations['lon'] = df[lon_column]
+    return locations.dropna(subset=['lat', 'lon']).drop_duplicates('label')
+
+# Function to write the full origin x destination distance matrix as gzipped CSV to a path or binary file
+def write_distance_matrix(df, output, method="haversine"):
+    origins = matrix_locations(df, '_orig', 'orig_latitude', 'orig_longitude')
+    destinations = matrix_locations(df, '_dest', 'dest_latitude', 'dest_longitude')
+
+    with gzip.open(output, 'wt', newline='') as matrix_file:
+        write_distance_matrix_csv(matrix_file,
+                                  origins['label'], origins['lat'], origins['lon'],
+                                  destinations['label'], destinations['lat'], destinations['lon'],
+                                  method=method)
+
+# Function to export the full distance matrix in memory, for the download button
+def distance_matrix_csv(df, method="haversine"):
+    output = BytesIO()
+    write_distance_matrix(df, output, method)
+    return output.getvalue()
+
+# Function to split a file name or source label ("<file> [<sheet>] (<number>)") into a stem and the sheet name
+def _source_parts(label):
+    filename, sheet, number = re.fullmatch(r"(.*?)(?: \[(.*)\])?(?: \((\d+)\))?", os.path.basename(str(label))).groups()
+    stem = os.path.splitext(filename)[0]
+    return (f"{stem} ({number})" if number else stem), sheet
+
+def export_basename(original_filename):
+    current_date = datetime.now().strftime("%m%d%Y")
+    stem, sheet = _source_parts(original_filename)
+    if sheet:
+        stem += "_" + re.sub(r"[^\w.-]+", "_", sheet)
+    return f"{stem}_geocoding_details_{current_date}"
+
+# Function to turn source labels into valid, unique Excel sheet names
+def excel_sheet_names(labels):
+    names = []
+    for label in labels:
+        stem, sheet = _source_parts(label)
+        base = re.sub(r"[\[\]:*?/\\]", "_", f"{stem} {sheet}" if sheet else stem).strip("'") or "Sheet"
+        name, suffix = base[:MAX_SHEET_NAME], 1
+        while name.casefold() in (existing.casefold() for existing in names):
+            suffix += 1
+            name = f"{base[:MAX_SHEET_NAME - len(str(suffix)) - 1]}~{suffix}"
+        names.append(name)
+    return names
+
+# Function to write the results of a batch to one workbook, with a sheet per source, to a path or binary file
+def write_sources_to_excel(df, output):
+    sources = split_by_source(df)
+    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+        for sheet_name, part in zip(excel_sheet_names(sources), sources.values()):
+            part.to_excel(writer, index=False, sheet_name=sheet_name)
+
+# Function to slice the frame into row chunks; an empty frame still gives one (empty) chunk
+def _row_chunks(df, chunk_rows=EXPORT_CHUNK_ROWS):
+    for start in range(0, max(len(df), 1), chunk_rows):
+        yield df.iloc[start:start + chunk_rows]
+
+# Function to open a path for writing, or use an already open binary file as is
+def _open_output(output):
+    return open(output, 'wb') if isinstance(output, (str, os.PathLike)) else nullcontext(output)
+
+def _write_csv(df, output):
+    with _open_output(output) as handle:
+        for i, chunk in enumerate(_row_chunks(df)):
+            handle.write(chunk.to_csv(index=False, header=i == 0).encode())
+
+def _write_parquet(df, output):
+    # One row group per chunk, so only one chunk at a time is converted to Arrow
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    with pq.ParquetWriter(output, schema) as writer:
+        for chunk in _row_chunks(df):
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+# Function to build the GeoJSON geometry of every row: a point for one coordinate pair, a line through several
+def _geojson_geometries(chunk):
+    coordinates = []
+    located = pd.Series(True, index=chunk.index)
+    for lat_column, lon_column in GEOMETRY_COLUMNS:
+        if lat_column in chunk and lon_column in chunk:
+            lats = pd.to_numeric(chunk[lat_column], errors='coerce').astype(float).round(GEOJSON_DECIMALS)
+            lons = pd.to_numeric(chunk[lon_column], errors='coerce').astype(float).round(GEOJSON_DECIMALS)
+            coordinates.append("[" + lons.astype(str) + ", " + lats.astype(str) + "]")
+            located &= lats.notna() & lons.notna()
+
+    if not coordinates:
+        return pd.Series("null", index=chunk.index)
+    if len(coordinates) == 1:
+        geometries = '{"type": "Point", "coordinates": ' + coordinates[0] + '}'
+    else:
+        geometries = ('{"type": "LineString", "coordinates": [' +
+                      coordinates[0].str.cat(coordinates[1:], sep=", ") + ']}')
+    # A row missing any of its coordinates has no geometry
+    return geometries.where(located, "null")
+
+def _write_geojson(df, output):
+    with _open_output(output) as handle:
+        handle.write(b'{"type": "FeatureCollection", "features": [\n')
+        for i, chunk in enumerate(_row_chunks(df)):
+            if chunk.empty:
+                continue
+            properties = chunk.to_json(orient='records', lines=True, date_format='iso').splitlines()
+            features = [f'{{"type": "Feature", "geometry": {geometry}, "properties": {record}}}'
+                        for geometry, record in zip(_geojson_geometries(chunk).tolist(), properties)]
+            handle.write(((",\n" if i else "") + ",\n".join(features)).encode())
+        handle.write(b"\n]}\n")
+
+# Function to write the results in the given format to a path or binary file.
+# csv, parquet and GeoJSON are written in row chunks, so no second full copy of the frame is built.
+def write_output(df, output, output_format='xlsx'):
+    if output_format == 'xlsx':
+        if len(df) > EXCEL_MAX_ROWS:
+            raise ValueError(f"{len(df):,} rows don't fit in an Excel sheet; export as csv or parquet instead")
+        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+            df.to_excel(writer, index=False, sheet_name='Geocoding Data')
+    elif output_format == 'csv':
+        _write_csv(df, output)
+    elif output_format == 'parquet':
+        _write_parquet(df, output)
+    elif output_format == 'geojson':
+        _write_geojson(df, output)
+    else:
+        raise ValueError(f"Unsupported output format: {output_format}")
+
+# Function to name the file export_results writes
+def export_filename(export_name, output_format='xlsx', map_included=False):
+    return f"{export_basename(export_name)}.{'zip' if map_included else output_format}"
+
+# Function to export the results as the bytes of the download, optionally zipped together with the map page.
+# With by_source an xlsx export gets a sheet per source; the other formats keep the source column.
+def export_results(df, export_name, output_format='xlsx', map_html=None, by_source=False):
+    with profiler.stage("results export"):
+        with _export_file(df, export_name, output_format, map_html, by_source) as export:
+            # The download widget only takes bytes, str or a BytesIO, not an open file
+            return export.read()
+
+def _export_file(df, export_name, output_format, map_html, by_source):
+    # Written to a temporary file, so the writers and the zip never hold a second copy in memory
+    results = tempfile.TemporaryFile()
+    if by_source and output_format == 'xlsx':
+        write_sources_to_excel(df, results)
+    else:
+        write_output(df, results, output_format)
+    results.seek(0)
+    if map_html is None:
+        return results
+
+    # Copied into the zip in blocks rather than read back whole
+    bundle = tempfile.TemporaryFile()
+    basename = export_basename(export_name)
+    with results, ZipFile(bundle, 'w', compression=ZIP_DEFLATED) as zip_file:
+        with zip_file.open(f"{basename}.{output_format}", 'w') as entry:
+            shutil.copyfileobj(results, entry)
+        zip_file.writestr(f"{basename}_map.html", map_html)
+    bundle.seek(0)
+    return bundle
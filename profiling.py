@@ -0,0 +1,72 @@
+import json
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+
+class Profiler:
+    """Collects per-stage timings, event counters and gauges for a run.
+
+    The profiler is shared by the whole process (geocoding workers included),
+    so runs of concurrent sessions add up; call reset() at the start of a run.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.stages = defaultdict(lambda: {'calls': 0, 'total_seconds': 0.0, 'last_seconds': 0.0})
+            self.counters = Counter()
+            self.gauges = {}
+
+    def record(self, name, seconds):
+        with self._lock:
+            stage = self.stages[name]
+            stage['calls'] += 1
+            stage['total_seconds'] += seconds
+            stage['last_seconds'] = seconds
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def hit_rates(self):
+        """Share of address lookups answered by each source (gazetteer, cache, online, error)."""
+        with self._lock:
+            lookups = {name.split('.', 1)[1]: count for name, count in self.counters.items()
+                       if name.startswith('lookups.')}
+        total = sum(lookups.values())
+        return {source: count / total for source, count in lookups.items()} if total else {}
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = {
+                'started': self.started,
+                'stages': {name: dict(stage) for name, stage in self.stages.items()},
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+            }
+        snapshot['hit_rates'] = self.hit_rates()
+        return snapshot
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+
+profiler = Profiler()
@@ -0,0 +1,191 @@
+import folium
+import numpy as np
+import pandas as pd
+from branca.colormap import LinearColormap
+
+from binning import aggregate_volume, precision_for_zoom, zoom_for_bounds
+from flows import aggregate_flows, bundle_flows, flow_segments, flow_weights, BUNDLE_CELL_PX
+from layers import add_circle_markers, add_lines, add_tiled_layer, GridCellLayer
+
+# Dot colors per layer (transit days); anything else is drawn grey
+LAYER_COLORS = {
+    1: "#4D148C", 2: "#FF6200", 3: "#671CAA", 4: "#7D22C3", 5: "#932DA2", 6: "#A63685",
+    7: "#B83F6A", 8: "#C74755", 9: "#D87E88", 10: "#C172AA",
+    # Add more colors here #
+}
+DEFAULT_COLOR = "#808080"
+DOT_SIZE = 2
+
+# Function to create an empty world map
+def new_map():
+    initial_location = [20, 0]
+    return folium.Map(location=initial_location, zoom_start=2)
+
+# Function to render the map to the standalone HTML page the app embeds
+def render_html(map_object):
+    return folium.Figure().add_child(map_object).render()
+
+def scale_dot_size(volume, min_volume, max_volume):
+    """Dynamically scale the dot size based on the volume value."""
+    min_size = 2  # Minimum dot size
+    max_size = 15  # Maximum dot size
+    if max_volume == min_volume:  # Prevent division by zero
+        return min_size
+    return min_size + (max_size - min_size) * ((volume - min_volume) / (max_volume - min_volume))
+
+# Function to draw aggregated volume cells, shaded by their total volume
+def add_volume_cells(map_object, cells):
+    min_volume = cells['volume'].min()
+    max_volume = max(cells['volume'].max(), min_volume + 1)  # The color scale needs a non-empty range
+    colormap = LinearColormap(["#D87E88", "#4D148C"], vmin=min_volume, vmax=max_volume, caption="Volume per cell")
+
+    fill_colors = [colormap(volume) for volume in cells['volume']]
+    tooltips = [f"{geohash}: volume {volume:,.0f} over {count} row(s)"
+                for geohash, volume, count in zip(cells['geohash'], cells['volume'], cells['count'])]
+    GridCellLayer(cells['south'], cells['west'], cells['north'], cells['east'], fill_colors, tooltips).add_to(map_object)
+    colormap.add_to(map_object)
+
+# Function to look up the color of every value, grey for values without one
+def layer_color_column(values, layer_colors):
+    return values.map(layer_colors).fillna(DEFAULT_COLOR)
+
+# Function to select the rows whose coordinates are known, as float64 latitude and longitude arrays
+def located_points(df, lat_column, lon_column):
+    lats = pd.to_numeric(df[lat_column], errors='coerce').to_numpy(dtype=float)
+    lons = pd.to_numeric(df[lon_column], errors='coerce').to_numpy(dtype=float)
+    located = np.isfinite(lats) & np.isfinite(lons)
+    return located, lats[located], lons[located]
+
+# Function to fit the map to the bounding box of the given points
+def fit_to_points(map_object, lats, lons):
+    if len(lats):
+        map_object.fit_bounds([[lats.min(), lons.min()], [lats.max(), lons.max()]])
+
+# Function to plot one dot per located row, colored by its layer; returns the layers that were plotted
+def plot_standard(map_object, df, layer_colors=LAYER_COLORS, dot_size=DOT_SIZE, batched=True, tiled=False):
+    located, lats, lons = located_points(df, 'latitude', 'longitude')
+    layers = df['layer'][located]
+
+    markers = pd.DataFrame({'lat': lats, 'lon': lons, 'radius': float(dot_size),
+                            'color': layer_color_column(layers, layer_colors).to_numpy()})
+    if tiled:
+        add_tiled_layer(map_object, markers)
+    else:
+        add_circle_markers(map_object, markers, batched=batched)
+
+    # Fit the map to the bounds of all plotted locations
+    fit_to_points(map_object, lats, lons)
+
+    return set(layers.tolist())
+
+# Function to plot volumes, either as one dot per row sized by volume or as shaded grid cells
+def plot_volume(map_object, df, layer_colors=LAYER_COLORS, batched=True, display="Dots per row", grid_precision="Auto",
+                tiled=False):
+    located, lats, lons = located_points(df, 'latitude', 'longitude')
+
+    if display == "Aggregated grid":
+        # Bin the points into geohash cells and draw one shaded cell per bin
+        if len(lats):
+            precision = grid_precision
+            if precision == "Auto":
+                zoom = zoom_for_bounds(lats.min(), lons.min(), lats.max(), lons.max())
+                precision = precision_for_zoom(zoom)
+
+            cells = aggregate_volume(lats, lons, df['volume'][located], precision)
+            add_volume_cells(map_object, cells)
+            fit_to_points(map_object, np.concatenate([cells['south'], cells['north']]),
+                          np.concatenate([cells['west'], cells['east']]))
+        return
+
+    # Find min and max volume for smart scaling, once for all rows
+    volumes = pd.to_numeric(df['volume'], errors='coerce')
+    min_volume = volumes.min()
+    max_volume = volumes.max()
+
+    markers = pd.DataFrame({
+        'lat': lats,
+        'lon': lons,
+        'radius': scale_dot_size(volumes.to_numpy(dtype=float)[located], min_volume, max_volume),
+        'color': layer_color_column(df['volume'][located], layer_colors).to_numpy(),
+        'fill_color': DEFAULT_COLOR,
+    })
+    if tiled:
+        add_tiled_layer(map_object, markers)
+    else:
+        add_circle_markers(map_object, markers, batched=batched)
+
+    # Fit the map to the bounds of all plotted locations
+    fit_to_points(map_object, lats, lons)
+
+# Function to plot warehouses, destinations and the lanes between them; returns the layers that were plotted.
+# Each lane and place is drawn once, lane weights grow with the shipment count; bundled lanes share a trunk
+# line into each destination area.
+def plot_supply_chain(map_object, df, layer_colors=LAYER_COLORS, dot_size=DOT_SIZE, batched=True, tiled=False,
+                      flow_lines="One line per lane"):
+    warehouse_located, warehouse_lats, warehouse_lons = located_points(df, 'warehouse_lat', 'warehouse_lon')
+    located, lats, lons = located_points(df, 'latitude', 'longitude')
+
+    # Many shipments share a warehouse or destination; keeping the last one keeps the paint order
+    warehouse_markers = pd.DataFrame({'lat': warehouse_lats, 'lon': warehouse_lons,
+                                      'radius': dot_size * 1.5, 'color': 'yellow'}).drop_duplicates(keep='last')
+    markers = pd.DataFrame({'lat': lats, 'lon': lons, 'radius': float(dot_size),
+                            'color': layer_color_column(df['layer'][located], layer_colors).to_numpy()}
+                           ).drop_duplicates(keep='last')
+
+    # Lanes connect warehouse and destination where both are known, as (n, 2 ends, lat/lon) segments
+    both = warehouse_located & located
+    lanes = aggregate_flows(df['warehouse_lat'][both], df['warehouse_lon'][both],
+                            df['latitude'][both], df['longitude'][both], df['layer'][both])
+    if flow_lines == "Bundled by destination area" and not lanes.empty:
+        zoom = zoom_for_bounds(min(warehouse_lats.min(), lats.min()), min(warehouse_lons.min(), lons.min()),
+                               max(warehouse_lats.max(), lats.max()), max(warehouse_lons.max(), lons.max()))
+        lines, counts = bundle_flows(lanes, precision_for_zoom(zoom, target_cell_px=BUNDLE_CELL_PX))
+    else:
+        lines, counts = flow_segments(lanes)
+    weights = flow_weights(counts)
+
+    # Lines go underneath the destination and warehouse markers
+    if tiled:
+        add_tiled_layer(map_object, pd.concat([markers, warehouse_markers], ignore_index=True), lines,
+                        line_weights=weights, color='grey', opacity=1)
+    else:
+        add_lines(map_object, lines, batched=batched, weights=weights, color='grey', opacity=1)
+        add_circle_markers(map_object, markers, batched=batched)
+        add_circle_markers(map_object, warehouse_markers, batched=batched)
+
+    # Fit the map to the bounds of all plotted locations
+    fit_to_points(map_object, np.concatenate([warehouse_lats, lats]), np.concatenate([warehouse_lons, lons]))
+
+    return set(df['layer'][both].tolist())
+
+# Function to plot the results of a scenario with the given styling; returns the layers that were plotted
+def plot_scenario(map_object, df, scenario, styling):
+    if scenario == "Standard visualization":
+        return plot_standard(map_object, df, styling['layer_colors'], styling['dot_size'],
+                             batched=styling['batched'], tiled=styling['tiled'])
+    if scenario == "Volume visualization":
+        plot_volume(map_object, df, styling['layer_colors'], batched=styling['batched'],
+                    display=styling['volume_display'], grid_precision=styling['grid_precision'],
+                    tiled=styling['tiled'])
+    elif scenario == "Supply-chain visualization":
+        return plot_supply_chain(map_object, df, styling['layer_colors'], styling['dot_size'],
+                                 batched=styling['batched'], tiled=styling['tiled'],
+                                 flow_lines=styling['flow_lines'])
+    elif scenario == "Nearest warehouse assignment":
+        # Each destination is linked to its nearest warehouse and colored by it
+        return plot_supply_chain(map_object, df.assign(layer=df['warehouse_1']), styling['layer_colors'],
+                                 styling['dot_size'], batched=styling['batched'], tiled=styling['tiled'],
+                                 flow_lines=styling['flow_lines'])
+    return set()
+
+# Function to give every warehouse a color of its own, repeating the layer colors when there are more warehouses
+def warehouse_colors(warehouses):
+    colors = list(LAYER_COLORS.values())
+    return {warehouse: colors[i % len(colors)] for i, warehouse in enumerate(sorted(set(warehouses)))}
+
+# Function to render the results as a page that works on its own; tiles need the local tile server, so the
+# points are embedded instead
+def standalone_map_html(df, scenario, styling):
+    map_object = new_map()
+    plot_scenario(map_object, df, scenario, {**styling, 'tiled': False, 'batched': True})
+    return render_html(map_object)
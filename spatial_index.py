@@ -0,0 +1,144 @@
+import numpy as np
+
+from distance import EARTH_RADIUS_KM
+
+LEAF_SIZE = 32  # Points per leaf at most; leaves hold at least half of this
+MAX_NEAREST = LEAF_SIZE // 2  # Most neighbours a query can ask for
+QUERY_CHUNK_ROWS = 10_000  # Query points walked through the tree at once, keeps the candidate pairs in memory bounds
+
+
+def unit_vectors(lats, lons):
+    """Points on the unit sphere as (n, 3) x, y, z coordinates."""
+    lats = np.radians(np.asarray(lats, dtype=float))
+    lons = np.radians(np.asarray(lons, dtype=float))
+    return np.column_stack([np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons), np.sin(lats)])
+
+
+def chord_to_km(chord):
+    """Great-circle distance in km for the straight-line distance between two points on the unit sphere."""
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(np.asarray(chord, dtype=float) / 2, 0, 1))
+
+
+class SphereTree:
+    """k-d tree over points on the earth for k-nearest-neighbour queries by great-circle distance.
+
+    The points are stored as 3D unit vectors. The straight-line distance
+    between two of them grows with their great-circle distance, so the
+    nearest points through the sphere are the nearest along it, and plain
+    bounding boxes can prune the search. Queries walk the tree for a whole
+    chunk of points at once instead of one point at a time.
+    """
+
+    def __init__(self, lats, lons, leaf_size=LEAF_SIZE):
+        points = unit_vectors(lats, lons)
+        order = np.arange(len(points))
+
+        # Nodes in breadth-first order, each covering the points order[start:end]
+        starts, ends, children, lows, highs = [0], [len(points)], [], [], []
+        node = 0
+        while node < len(starts):
+            start, end = starts[node], ends[node]
+            node_points = points[order[start:end]]
+            lows.append(node_points.min(axis=0) if end > start else np.full(3, np.inf))
+            highs.append(node_points.max(axis=0) if end > start else np.full(3, -np.inf))
+            if end - start > leaf_size:
+                # Split at the median of the widest dimension
+                dimension = np.argmax(highs[-1] - lows[-1])
+                half = (end - start) // 2
+                order[start:end] = order[start:end][np.argpartition(node_points[:, dimension], half)]
+                children.append((len(starts), len(starts) + 1))
+                starts += [start, start + half]
+                ends += [start + half, end]
+            else:
+                children.append((-1, -1))
+            node += 1
+
+        self.points = points[order]
+        self.index = order  # Position of each tree point in the input
+        self.start = np.array(starts)
+        self.end = np.array(ends)
+        self.left, self.right = np.array(children).reshape(-1, 2).T
+        self.low = np.array(lows)
+        self.high = np.array(highs)
+        leaves = self.left < 0
+        self.min_leaf = (self.end - self.start)[leaves].min()
+        self.max_leaf = (self.end - self.start)[leaves].max()
+
+    def __len__(self):
+        return len(self.points)
+
+    def _box_distances(self, queries, nodes):
+        # Squared distance from each query to the bounding box of its node, 0 inside the box
+        below = np.maximum(self.low[nodes] - queries, 0)
+        above = np.maximum(queries - self.high[nodes], 0)
+        return ((below + above) ** 2).sum(axis=1)
+
+    def _query_chunk(self, queries, k):
+        rows = np.arange(len(queries))
+
+        # Descend towards the closest leaf, whose k nearest points bound the search radius
+        nodes = np.zeros(len(queries), dtype=int)
+        inner = self.left[nodes] >= 0
+        while inner.any():
+            left, right = self.left[nodes[inner]], self.right[nodes[inner]]
+            closer_left = (self._box_distances(queries[inner], left) <=
+                           self._box_distances(queries[inner], right))
+            nodes[inner] = np.where(closer_left, left, right)
+            inner = self.left[nodes] >= 0
+        offsets = np.arange(self.max_leaf)
+        positions = self.start[nodes, None] + offsets
+        in_leaf = positions < self.end[nodes, None]
+        leaf_distances = ((self.points[np.where(in_leaf, positions, 0)] - queries[:, None]) ** 2).sum(axis=2)
+        radius = np.partition(np.where(in_leaf, leaf_distances, np.inf), k - 1, axis=1)[:, k - 1]
+        radius *= 1 + 1e-9  # Ties at the radius must not be pruned by rounding
+
+        # Walk down every branch whose box is within the radius, collecting the leaves reached
+        pair_rows, pair_nodes = rows, np.zeros(len(queries), dtype=int)
+        leaf_rows, leaf_nodes = [], []
+        while len(pair_rows):
+            within = self._box_distances(queries[pair_rows], pair_nodes) <= radius[pair_rows]
+            pair_rows, pair_nodes = pair_rows[within], pair_nodes[within]
+            leaf = self.left[pair_nodes] < 0
+            leaf_rows.append(pair_rows[leaf])
+            leaf_nodes.append(pair_nodes[leaf])
+            pair_rows = np.repeat(pair_rows[~leaf], 2)
+            pair_nodes = np.column_stack([self.left[pair_nodes[~leaf]], self.right[pair_nodes[~leaf]]]).ravel()
+
+        # Expand the (query, leaf) pairs into (query, point) candidates and keep the k closest per query
+        leaf_rows, leaf_nodes = np.concatenate(leaf_rows), np.concatenate(leaf_nodes)
+        sizes = self.end[leaf_nodes] - self.start[leaf_nodes]
+        candidate_rows = np.repeat(leaf_rows, sizes)
+        candidates = (np.repeat(self.start[leaf_nodes] - np.cumsum(sizes) + sizes, sizes)
+                      + np.arange(sizes.sum()))
+        distances = ((self.points[candidates] - queries[candidate_rows]) ** 2).sum(axis=1)
+        # Only the points within the radius can be among the k nearest, which leaves far fewer to sort
+        close = distances <= radius[candidate_rows]
+        candidates, candidate_rows, distances = candidates[close], candidate_rows[close], distances[close]
+        ordered = np.lexsort((distances, candidate_rows))
+        first = np.searchsorted(candidate_rows[ordered], rows)
+        nearest = ordered[first[:, None] + np.arange(k)]
+        return self.index[candidates[nearest]], np.sqrt(distances[nearest])
+
+    def query(self, lats, lons, k=1):
+        """Find the k nearest points of the tree to each query point.
+
+        Returns (indexes, distances): (n, k) arrays with the input positions of
+        the nearest points, closest first, and their great-circle distances in
+        km. Query points without coordinates get index -1 and a NaN distance.
+        """
+        if not 1 <= k <= MAX_NEAREST:
+            raise ValueError(f"k must be between 1 and {MAX_NEAREST}, got {k}")
+        queries = unit_vectors(lats, lons)
+        indexes = np.full((len(queries), k), -1)
+        distances = np.full((len(queries), k), np.nan)
+
+        # Every leaf holds at least k points, unless the whole tree has fewer
+        k_found = min(k, self.min_leaf)
+        if k_found == 0:
+            return indexes, distances
+        located = np.flatnonzero(np.isfinite(queries).all(axis=1))
+        for start in range(0, len(located), QUERY_CHUNK_ROWS):
+            rows = located[start:start + QUERY_CHUNK_ROWS]
+            indexes[rows, :k_found], chords = self._query_chunk(queries[rows], k_found)
+            distances[rows, :k_found] = chord_to_km(chords)
+        return indexes, distances
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# The modules live at the repository root, next to mapping.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Keep the default geocode cache and job checkpoints out of the source tree while testing
+os.environ.setdefault("GEOCODE_CACHE_PATH", os.path.join(tempfile.mkdtemp(prefix="geocode-tests-"), "cache.sqlite"))
+os.environ.setdefault("GEOCODE_JOBS_DIR", os.path.join(tempfile.mkdtemp(prefix="geocode-tests-"), "jobs"))
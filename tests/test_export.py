@@ -0,0 +1,35 @@
+"""Exports must be data the Streamlit download button accepts, with the map bundled when asked for."""
+import io
+from zipfile import ZipFile
+
+import pandas as pd
+import pytest
+from streamlit.runtime.download_data_util import convert_data_to_bytes_and_infer_mime
+
+from pipeline import export_results, OUTPUT_FORMATS, SOURCE_COLUMN
+
+RESULTS = pd.DataFrame({
+    'city': ["Berlin", "Paris"],
+    'latitude': [52.52, 48.857],
+    'longitude': [13.405, 2.352],
+    SOURCE_COLUMN: ["a.csv", "b.csv"],
+})
+
+
+def download_bytes(data):
+    converted, _ = convert_data_to_bytes_and_infer_mime(data, TypeError(f"Unsupported download data {type(data)}"))
+    return converted
+
+
+@pytest.mark.parametrize("output_format", OUTPUT_FORMATS)
+def test_export_is_accepted_by_the_download_button(output_format):
+    data = download_bytes(export_results(RESULTS, "results", output_format, by_source=True))
+    assert data
+
+
+def test_map_is_bundled_with_the_export():
+    data = download_bytes(export_results(RESULTS, "results", 'csv', map_html="<html></html>"))
+    with ZipFile(io.BytesIO(data)) as bundle:
+        table, page = sorted(bundle.namelist())
+        assert table.endswith(".csv") and page.endswith("_map.html")
+        assert pd.read_csv(bundle.open(table))['city'].tolist() == ["Berlin", "Paris"]
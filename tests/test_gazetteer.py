@@ -0,0 +1,48 @@
+"""Gazetteer lookups answer unambiguous postal codes and places offline and leave the rest to the geocoder."""
+import pytest
+
+from gazetteer import build_gazetteer, PostalGazetteer
+
+# GeoNames layout: country, postal code, place, admin name/code 1-3, latitude, longitude, accuracy
+DUMP = [
+    ("DE", "10115", "Berlin", "Berlin", "BE", "", "", "", "", "52.5323", "13.3846", "4"),
+    ("DE", "10117", "Berlin", "Berlin", "BE", "", "", "", "", "52.5170", "13.3872", "4"),
+    # One Neustadt in Hesse, one in Saxony
+    ("DE", "35279", "Neustadt", "Hessen", "HE", "", "", "", "", "50.8500", "9.1167", "4"),
+    ("DE", "01844", "Neustadt", "Sachsen", "SN", "", "", "", "", "51.0240", "14.2168", "4"),
+    # A postal code shared by two villages next to each other, and one shared by places far apart
+    ("DE", "99998", "Körner", "Thüringen", "TH", "", "", "", "", "51.2311", "10.5882", "4"),
+    ("DE", "99998", "Weinbergen", "Thüringen", "TH", "", "", "", "", "51.2000", "10.5667", "4"),
+    ("DE", "00001", "Nord", "", "", "", "", "", "", "54.0000", "10.0000", "4"),
+    ("DE", "00001", "Süd", "", "", "", "", "", "", "48.0000", "10.0000", "4"),
+]
+
+
+@pytest.fixture
+def gazetteer(tmp_path):
+    source = tmp_path / "DE.txt"
+    source.write_text("".join("\t".join(row) + "\n" for row in DUMP), encoding="utf-8")
+    assert build_gazetteer(str(source), str(tmp_path / "gazetteer.sqlite")) == len(DUMP)
+    return PostalGazetteer(str(tmp_path / "gazetteer.sqlite"))
+
+
+def test_postal_code_and_place_hits(gazetteer):
+    assert gazetteer.lookup("DE", "10115", "berlin") == (52.5323, 13.3846, "10115", "berlin", "DE")
+    lat, lon, *_ = gazetteer.lookup("DE", "99998")
+    assert lat == pytest.approx((51.2311 + 51.2000) / 2) and lon == pytest.approx((10.5882 + 10.5667) / 2)
+    lat, lon, postal_code, city, country_code = gazetteer.lookup("DE", city="berlin")
+    assert (postal_code, city, country_code) == (None, "berlin", "DE") and lat == pytest.approx(52.52465)
+
+
+def test_ambiguous_places_fall_through(gazetteer):
+    assert gazetteer.lookup("DE", city="neustadt") is None
+    assert gazetteer.lookup("DE", "00001") is None
+    # The place narrows a shared postal code down to one location
+    assert gazetteer.lookup("DE", "00001", "nord")[:2] == (54.0, 10.0)
+
+
+def test_misses(gazetteer):
+    assert gazetteer.lookup("DE", "99999") is None
+    assert gazetteer.lookup("DE", city="atlantis") is None
+    assert gazetteer.lookup("FR", "10115") is None
+    assert gazetteer.lookup("DE") is None
@@ -0,0 +1,161 @@
+"""Offline tests of the geocoding engine against a stand-in Nominatim server."""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from geopy.exc import GeocoderRateLimited
+from geopy.location import Location
+
+import geocoding
+from geocoding import configure_engine, GeocodingEngine, NominatimBackend, QueryMemo, resolve_location, TokenBucket
+from profiling import profiler
+
+PLACE = [{'lat': "52.52", 'lon': "13.405", 'display_name': "Berlin"}]
+
+
+class StandInNominatim:
+    """Search endpoint answering from a script of responses, one per request.
+
+    Each entry is ("ok",), ("429", retry_after or None) or ("slow", seconds);
+    once the script runs out every request is answered normally.
+    """
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.request_times = []
+        self._lock = threading.Lock()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with stand_in._lock:
+                    stand_in.request_times.append(time.monotonic())
+                    step = stand_in.script.pop(0) if stand_in.script else ("ok",)
+                if step[0] == "429":
+                    self.send_response(429)
+                    if step[1] is not None:
+                        self.send_header("Retry-After", str(step[1]))
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                if step[0] == "slow":
+                    time.sleep(step[1])
+                data = json.dumps(PLACE).encode()
+                try:
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                except ConnectionError:
+                    pass  # The client gave up waiting for a slow answer
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def requests(self):
+        return len(self.request_times)
+
+    def engine(self, requests_per_second=1000, timeout=5, max_retries=3, backoff_base=0.05):
+        backend = NominatimBackend(domain=f"127.0.0.1:{self.server.server_port}", scheme="http",
+                                   user_agent="tests", timeout=timeout)
+        return GeocodingEngine(backend, requests_per_second=requests_per_second, workers=2,
+                               max_retries=max_retries, backoff_base=backoff_base, backoff_max=0.2)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stand_in(request):
+    server = StandInNominatim(getattr(request, 'param', []))
+    profiler.reset()
+    yield server
+    server.close()
+
+
+def test_token_bucket_paces_requests():
+    bucket = TokenBucket(20)
+    started = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    # The first token is ready at once, the other five come 1/20 s apart
+    assert time.monotonic() - started >= 5 / 20 * 0.9
+
+
+def test_token_bucket_pause_holds_back_acquire():
+    bucket = TokenBucket(1000)
+    bucket.pause(0.3)
+    started = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - started >= 0.25
+
+
+@pytest.mark.parametrize("rate", [0, -1])
+def test_rate_must_be_positive(rate):
+    with pytest.raises(ValueError):
+        TokenBucket(rate)
+    with pytest.raises(ValueError):
+        configure_engine(requests_per_second=rate)
+
+
+@pytest.mark.parametrize("stand_in", [[("ok",)] * 4], indirect=True)
+def test_engine_paces_requests_through_the_bucket(stand_in):
+    engine = stand_in.engine(requests_per_second=10)
+    for _ in range(4):
+        assert engine.geocode("Berlin").latitude == 52.52
+    gaps = [later - earlier for earlier, later in zip(stand_in.request_times, stand_in.request_times[1:])]
+    assert min(gaps) >= 0.1 * 0.8
+
+
+@pytest.mark.parametrize("stand_in", [[("429", 1)]], indirect=True)
+def test_rate_limited_request_waits_for_retry_after(stand_in):
+    engine = stand_in.engine()
+    location = engine.geocode("Berlin")
+
+    assert location.latitude == 52.52
+    assert stand_in.requests == 2
+    assert stand_in.request_times[1] - stand_in.request_times[0] >= 0.9
+    assert profiler.snapshot()['counters']['geocoder_retries.rate_limited'] == 1
+
+
+@pytest.mark.parametrize("stand_in", [[("429", None)] * 10], indirect=True)
+def test_rate_limited_request_gives_up_after_max_retries(stand_in):
+    engine = stand_in.engine(max_retries=2)
+    with pytest.raises(GeocoderRateLimited):
+        engine.geocode("Berlin")
+    assert stand_in.requests == 3
+
+
+@pytest.mark.parametrize("stand_in", [[("slow", 1.0), ("slow", 1.0)]], indirect=True)
+def test_timed_out_request_is_retried_with_backoff(stand_in):
+    engine = stand_in.engine(timeout=0.3)
+    location = engine.geocode("Berlin")
+
+    assert location.latitude == 52.52
+    assert stand_in.requests == 3
+    assert profiler.snapshot()['counters']['geocoder_retries.timed_out'] == 2
+
+
+def test_missing_capital_does_not_skip_other_addresses_of_the_country(monkeypatch):
+    # The capital query can miss (a stale or partial index) while postal codes of the country still resolve
+    asked = []
+
+    def geocode(query, country_codes):
+        asked.append(query)
+        return Location("Berlin", (52.52, 13.405), {}) if isinstance(query, dict) else None
+
+    monkeypatch.setattr(geocoding.engine, "geocode", geocode)
+    queries = QueryMemo()
+    assert resolve_location("DE", queries=queries) == geocoding.EMPTY_RESULT
+    assert resolve_location("DE", "10115", queries=queries) == (52.52, 13.405, "10115", None, "DE")
+    assert resolve_location("DE", queries=queries) == geocoding.EMPTY_RESULT
+    assert asked == [geocoding.capital_query("DE"), {'postalcode': "10115"}]
@@ -0,0 +1,104 @@
+"""Geocoding jobs must keep failed lookups pending, so they are retried when the job is started again."""
+import threading
+import time
+
+import pandas as pd
+import pytest
+from geopy.exc import GeocoderUnavailable
+from geopy.location import Location
+
+import geocoding
+import jobs
+from geocache import GeocodeCache
+from geocoding import GEOCODE_COLUMNS
+
+
+class DownBackend:
+    def geocode(self, query, **kwargs):
+        raise GeocoderUnavailable("geocoder down")
+
+
+class UpBackend:
+    def geocode(self, query, **kwargs):
+        return Location("somewhere", (52.52, 13.405), {})
+
+
+@pytest.fixture
+def offline_geocoding(tmp_path, monkeypatch):
+    monkeypatch.setattr(geocoding, "geocode_cache", GeocodeCache(str(tmp_path / "cache.sqlite")))
+    monkeypatch.setattr(geocoding, "gazetteer", None)
+    monkeypatch.setattr(geocoding.engine, "bucket", geocoding.TokenBucket(10_000))
+    monkeypatch.setattr(jobs, "_jobs", {})
+    return tmp_path
+
+
+def run_job(job_id, df, jobs_dir):
+    job = jobs.start_job(job_id, df, GEOCODE_COLUMNS["Standard visualization"], str(jobs_dir))
+    while job.running:
+        time.sleep(0.01)
+    return job
+
+
+def test_failed_lookups_stay_pending_and_are_retried(offline_geocoding, monkeypatch):
+    df = pd.DataFrame({'country_code': "DE", 'postal_code': [f"{i:05d}" for i in range(5)], 'city': "Berlin",
+                       'layer': 1})
+
+    monkeypatch.setattr(geocoding.engine, "backend", DownBackend())
+    job = run_job("down", df, offline_geocoding)
+    assert not job.finished
+    assert job.done == 0
+    assert "geocoder down" in job.error
+    # Nothing was cached as a confirmed miss either
+    assert geocoding.geocode_cache.get(geocoding.normalize_address("DE", "00000", "Berlin")) is None
+
+    monkeypatch.setattr(geocoding.engine, "backend", UpBackend())
+    job = run_job("down", df, offline_geocoding)
+    assert job.finished
+    assert job.error is None
+    assert job.apply(df)['latitude'].eq(52.52).all()
+
+
+def test_idle_jobs_are_evicted_and_reloaded_from_their_checkpoint(offline_geocoding, monkeypatch):
+    monkeypatch.setattr(geocoding.engine, "backend", UpBackend())
+    df = pd.DataFrame({'country_code': ["DE"], 'postal_code': ["10115"], 'city': ["Berlin"], 'layer': [1]})
+    for i in range(jobs.MAX_IDLE_JOBS + 2):
+        run_job(f"job{i}", df, offline_geocoding)
+
+    assert len(jobs._jobs) == jobs.MAX_IDLE_JOBS
+    assert jobs.get_job("job0") is None
+    job = jobs.load_job("job0", df, GEOCODE_COLUMNS["Standard visualization"], str(offline_geocoding))
+    assert job.finished and not job.running
+
+
+def test_concurrent_starts_run_one_thread(offline_geocoding, monkeypatch):
+    calls = []
+
+    class SlowBackend(UpBackend):
+        def geocode(self, query, **kwargs):
+            calls.append(query)
+            time.sleep(0.2)
+            return super().geocode(query, **kwargs)
+
+    monkeypatch.setattr(geocoding.engine, "backend", SlowBackend())
+    df = pd.DataFrame({'country_code': ["DE"], 'postal_code': ["10115"], 'city': ["Berlin"], 'layer': [1]})
+    barrier = threading.Barrier(8)
+
+    def click_create():
+        barrier.wait()
+        jobs.start_job("shared", df, GEOCODE_COLUMNS["Standard visualization"], str(offline_geocoding))
+
+    class SlowStartThread(threading.Thread):
+        # Widens the gap between checking that the job isn't running and its thread being alive
+        def start(self):
+            time.sleep(0.05)
+            super().start()
+
+    sessions = [threading.Thread(target=click_create) for _ in range(8)]
+    monkeypatch.setattr(jobs.threading, "Thread", SlowStartThread)
+    for session in sessions:
+        session.start()
+    for session in sessions:
+        session.join()
+    job = run_job("shared", df, offline_geocoding)
+    assert job.finished
+    assert len(calls) == 1
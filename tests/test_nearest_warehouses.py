@@ -0,0 +1,34 @@
+"""Destinations of a batch are assigned to the nearest warehouses of their own source only."""
+import numpy as np
+import pandas as pd
+
+from pipeline import assign_nearest_warehouses, SOURCE_COLUMN
+
+
+def network(source, warehouses, destinations):
+    return pd.DataFrame({
+        SOURCE_COLUMN: source,
+        'country_code_warehouse': [country for country, _, _ in warehouses],
+        'postal_code_warehouse': None,
+        'city_warehouse': [city for _, city, _ in warehouses],
+        'warehouse_list_lat': [lat for _, _, (lat, _) in warehouses],
+        'warehouse_list_lon': [lon for _, _, (_, lon) in warehouses],
+        'latitude': [lat for lat, _ in destinations],
+        'longitude': [lon for _, lon in destinations],
+    })
+
+
+def test_warehouses_are_not_pooled_across_sources():
+    df = pd.concat([
+        network("a.csv", [("DE", "Berlin", (52.52, 13.405)), ("FR", "Paris", (48.857, 2.352))],
+                [(52.4, 13.1), (48.9, 2.3)]),
+        # Potsdam is next to the Berlin warehouse of a.csv, but b.csv only ships from Munich and Lyon
+        network("b.csv", [("DE", "Munich", (48.137, 11.575)), ("FR", "Lyon", (45.764, 4.836))],
+                [(52.4, 13.1), (np.nan, np.nan)]),
+    ], ignore_index=True)
+    assign_nearest_warehouses(df, count=2)
+    assert df['warehouse_1'].tolist()[:3] == ["DE Berlin", "FR Paris", "DE Munich"]
+    assert df['warehouse_2'].tolist()[:3] == ["FR Paris", "DE Berlin", "FR Lyon"]
+    assert df[['warehouse_1', 'warehouse_2']].iloc[3].isna().all()
+    assert df['warehouse_lat'].tolist()[:3] == [52.52, 48.857, 48.137]
+    assert df['warehouse_1_km'].isna().tolist() == [False, False, False, True]
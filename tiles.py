@@ -0,0 +1,313 @@
+"""Local tile endpoint serving map points and lines per viewport tile.
+
+Instead of embedding every point in the map HTML, a dataset is registered
+with the tile server and the browser fetches only the tiles of the current
+viewport at the current zoom:
+
+    GET /tiles/<dataset id>/<z>/<x>/<y>.json
+
+Each tile holds the features that touch it in tile pixel coordinates, so the
+client only has to draw them onto a canvas.
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+TILE_SIZE = 256
+INDEX_ZOOM = 16  # Points are sorted along a Z-order curve of the tiles at this zoom
+MAX_ZOOM = 22
+MAX_LATITUDE = 85.0511  # Web Mercator stops here
+MAX_TILE_LINES = 20_000  # Lines drawn on one tile at most
+MAX_DATASETS = 8  # Registered datasets kept in memory, least recently used ones are dropped
+
+DEFAULT_HOST = os.environ.get("TILE_SERVER_HOST", "127.0.0.1")
+# A fixed port, so it can be forwarded next to Streamlit's 8501 (see .devcontainer); 0 picks a free port
+DEFAULT_PORT = int(os.environ.get("TILE_SERVER_PORT", "8502"))
+
+
+# Function to find the base URL the browser reaches the server at, when that isn't http://host:port
+def public_url_from_env(port=DEFAULT_PORT):
+    if os.environ.get("TILE_SERVER_URL"):  # E.g. behind a proxy
+        return os.environ["TILE_SERVER_URL"]
+    # GitHub Codespaces forwards every port at an HTTPS address of its own
+    if os.environ.get("CODESPACE_NAME") and os.environ.get("GITHUB_CODESPACES_PORT_FORWARDING_DOMAIN") and port:
+        return (f"https://{os.environ['CODESPACE_NAME']}-{port}."
+                f"{os.environ['GITHUB_CODESPACES_PORT_FORWARDING_DOMAIN']}")
+    return None
+
+
+PUBLIC_URL = public_url_from_env()
+
+
+def mercator(lats, lons):
+    """Project coordinates to Web Mercator as fractions of the world, (0, 0) being the north-west corner."""
+    lats = np.radians(np.clip(np.asarray(lats, dtype=float), -MAX_LATITUDE, MAX_LATITUDE))
+    x = (np.asarray(lons, dtype=float) + 180) / 360
+    y = (1 - np.log(np.tan(lats) + 1 / np.cos(lats)) / np.pi) / 2
+    return np.clip(x, 0, 1), np.clip(y, 0, 1)
+
+
+def morton_codes(tile_x, tile_y):
+    """Interleave the bits of integer tile coordinates, so tiles of any lower zoom cover a contiguous range."""
+    tile_x = np.asarray(tile_x, dtype=np.int64)
+    tile_y = np.asarray(tile_y, dtype=np.int64)
+    codes = np.zeros(np.shape(tile_x), dtype=np.int64)
+    for bit in range(INDEX_ZOOM):
+        codes |= ((tile_x >> bit) & 1) << (2 * bit + 1)
+        codes |= ((tile_y >> bit) & 1) << (2 * bit)
+    return codes
+
+
+def clip_segments(x1, y1, x2, y2, low, high):
+    """Clip segments to the square [low, high] on both axes (Liang-Barsky).
+
+    Returns the (n, 4) visible parts and the mask of the segments they come from.
+    """
+    dx, dy = x2 - x1, y2 - y1
+    start, end = np.zeros(len(x1)), np.ones(len(x1))
+    visible = np.ones(len(x1), dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for p, q in ((-dx, x1 - low), (dx, high - x1), (-dy, y1 - low), (dy, high - y1)):
+            t = q / p
+            start = np.where(p < 0, np.maximum(start, t), start)
+            end = np.where(p > 0, np.minimum(end, t), end)
+            visible &= ~((p == 0) & (q < 0))
+    visible &= start <= end
+    start, end = start[visible, None], end[visible, None]
+    x1, y1, dx, dy = x1[visible, None], y1[visible, None], dx[visible, None], dy[visible, None]
+    return np.hstack([x1 + start * dx, y1 + start * dy, x1 + end * dx, y1 + end * dy]), visible
+
+
+def _style_codes(*columns):
+    # Number the distinct combinations of the columns, returning each row's number and the first row of each
+    codes, uniques = np.zeros(len(columns[0]), dtype=np.int64), [None]
+    for column in columns:
+        column_codes, column_uniques = pd.factorize(column)
+        codes, uniques = pd.factorize(codes * max(len(column_uniques), 1) + column_codes)
+    first_rows = np.full(len(uniques), len(codes), dtype=np.int64)
+    np.minimum.at(first_rows, codes, np.arange(len(codes)))
+    return codes, first_rows
+
+
+class TileDataset:
+    """Points (drawn as circle markers) and straight lines, indexed for tile queries.
+
+    markers is a frame with lat, lon, radius and color columns and optionally
+    fill_color; lines is an (n, 2, 2) array of [[lat, lon], [lat, lon]]
+    segments, optionally with a weight per line overriding the line style's.
+    Lines are drawn first, then the markers in frame order.
+    """
+
+    def __init__(self, markers, lines=None, fill_opacity=1.0, line_style=None, line_weights=None):
+        markers = markers[np.isfinite(markers['lat'].to_numpy(dtype=float)) &
+                          np.isfinite(markers['lon'].to_numpy(dtype=float))]
+        fill_colors = markers['fill_color'] if 'fill_color' in markers else markers['color']
+        self.fill_opacity = fill_opacity
+        self.line_style = {"color": "grey", "weight": 0.5, "opacity": 1, **(line_style or {})}
+
+        # Every point refers to one entry of a small table of distinct styles
+        radii, colors = np.round(markers['radius'].to_numpy(dtype=float), 1), markers['color'].to_numpy(dtype=object)
+        fill_colors = fill_colors.to_numpy(dtype=object)
+        style_codes, first_points = _style_codes(radii, colors, fill_colors)
+        self.styles = [[float(radii[i]), colors[i], fill_colors[i]] for i in first_points.tolist()]
+        self.margin = max([radius for radius, _, _ in self.styles], default=0) + 2  # Circle outlines spill over tile edges
+
+        x, y = mercator(markers['lat'], markers['lon'])
+        world_tiles = 1 << INDEX_ZOOM
+        codes = morton_codes(np.minimum(x * world_tiles, world_tiles - 1).astype(np.int64),
+                             np.minimum(y * world_tiles, world_tiles - 1).astype(np.int64))
+        order = np.argsort(codes, kind='stable')
+        self.codes = codes[order]
+        self.point_index = order  # Position of each sorted point in paint order
+        self.x, self.y, self.style_codes = x[order], y[order], style_codes[order]
+
+        lines = np.empty((0, 2, 2)) if lines is None else np.asarray(lines, dtype=float).reshape(-1, 2, 2)
+        line_weights = np.broadcast_to(np.asarray(self.line_style['weight'] if line_weights is None else line_weights,
+                                                  dtype=float), len(lines))
+        finite = np.isfinite(lines).all(axis=(1, 2))
+        lines, self.line_weights = lines[finite], line_weights[finite]
+        self.line_x, self.line_y = mercator(lines[:, :, 0], lines[:, :, 1])
+        self.line_bounds = (self.line_x.min(axis=1), self.line_y.min(axis=1),
+                            self.line_x.max(axis=1), self.line_y.max(axis=1))
+
+        self.id = self._fingerprint()
+
+    def _fingerprint(self):
+        digest = hashlib.sha256()
+        for values in (self.x, self.y, self.style_codes, self.point_index, self.line_x, self.line_y, self.line_weights):
+            digest.update(np.ascontiguousarray(values).tobytes())
+        digest.update(json.dumps([self.styles, self.fill_opacity, self.line_style], default=str).encode())
+        return digest.hexdigest()[:32]
+
+    def __len__(self):
+        return len(self.x)
+
+    def _candidate_points(self, z, tile_x, tile_y):
+        # The indexed tile containing this one and its neighbours, as ranges of the sorted codes
+        query_zoom = min(z, INDEX_ZOOM)
+        center_x, center_y = tile_x >> (z - query_zoom), tile_y >> (z - query_zoom)
+        shift = 2 * (INDEX_ZOOM - query_zoom)
+        world_tiles = 1 << query_zoom
+
+        ranges = []
+        for neighbour_x in range(max(center_x - 1, 0), min(center_x + 2, world_tiles)):
+            for neighbour_y in range(max(center_y - 1, 0), min(center_y + 2, world_tiles)):
+                code = int(morton_codes(neighbour_x, neighbour_y))
+                start, stop = np.searchsorted(self.codes, [code << shift, (code + 1) << shift])
+                if stop > start:
+                    ranges.append(np.arange(start, stop))
+        return np.concatenate(ranges) if ranges else np.empty(0, dtype=np.int64)
+
+    def tile(self, z, tile_x, tile_y):
+        """Return the features drawn on one tile in tile pixel coordinates."""
+        world_px = TILE_SIZE * (1 << z)
+        left, top = tile_x * TILE_SIZE, tile_y * TILE_SIZE
+        low, high = -self.margin, TILE_SIZE + self.margin
+
+        candidates = self._candidate_points(z, tile_x, tile_y)
+        x = self.x[candidates] * world_px - left
+        y = self.y[candidates] * world_px - top
+        inside = (x >= low) & (x <= high) & (y >= low) & (y <= high)
+        points = pd.DataFrame({'order': self.point_index[candidates][inside],
+                               'x': x[inside], 'y': y[inside],
+                               'style': self.style_codes[candidates][inside]}).sort_values('order')
+        # Opaque dots on the same pixel hide each other; keeping the last one keeps what is visible on top
+        if self.fill_opacity >= 1:
+            points = points[~points[['x', 'y']].round().duplicated(keep='last')]
+        # Only the styles used on this tile travel with it
+        used_styles, points['style'] = np.unique(points['style'].to_numpy(), return_inverse=True)
+
+        # Lines whose bounding box touches the tile, clipped to it
+        west, north, east, south = self.line_bounds
+        tile_west, tile_north, tile_width = left / world_px, top / world_px, TILE_SIZE / world_px
+        crossing = np.nonzero((east >= tile_west) & (west <= tile_west + tile_width) &
+                              (south >= tile_north) & (north <= tile_north + tile_width))[0]
+        lines, visible = clip_segments(self.line_x[crossing, 0] * world_px - left, self.line_y[crossing, 0] * world_px - top,
+                              self.line_x[crossing, 1] * world_px - left, self.line_y[crossing, 1] * world_px - top,
+                              -1, TILE_SIZE + 1)
+        lines = pd.DataFrame(np.column_stack([lines, self.line_weights[crossing][visible]]))
+        # Many shipments share a lane, which is the same line once clipped and snapped to pixels
+        lines = lines[~lines.round().duplicated()].to_numpy()
+        # Beyond this the tile is solid grey anyway, an even sample of the lines looks the same
+        if len(lines) > MAX_TILE_LINES:
+            lines = lines[np.linspace(0, len(lines) - 1, MAX_TILE_LINES).astype(np.int64)]
+        lines = lines[np.argsort(lines[:, 4], kind='stable')]  # Grouped by weight, so the client strokes each weight once
+
+        return {
+            'styles': [self.styles[style] for style in used_styles.tolist()],
+            'fill_opacity': self.fill_opacity,
+            'line_style': self.line_style,
+            'points': np.round(points[['x', 'y', 'style']].to_numpy(), 1).ravel().tolist(),
+            'lines': np.round(lines, 1).ravel().tolist(),
+        }
+
+
+class TileServer:
+    """Serves registered TileDatasets over HTTP from a background thread.
+
+    The server is shared by the whole process and started on the first
+    registration. Dataset ids are content hashes, so tiles never change and
+    browsers may cache them.
+    """
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, public_url=PUBLIC_URL):
+        self.host = host
+        self.port = port
+        self.public_url = public_url
+        self._datasets = OrderedDict()
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        if self.public_url:
+            return self.public_url.rstrip("/")
+        return f"http://{self.host}:{self._server.server_port}"
+
+    def _dataset(self, dataset_id):
+        with self._lock:
+            dataset = self._datasets.get(dataset_id)
+            if dataset is not None:
+                self._datasets.move_to_end(dataset_id)
+            return dataset
+
+    def _respond(self, path):
+        parts = path.strip("/").split("/")
+        if len(parts) != 5 or parts[0] != "tiles" or not parts[4].endswith(".json"):
+            return 404, None
+        dataset = self._dataset(parts[1])
+        try:
+            z, tile_x, tile_y = int(parts[2]), int(parts[3]), int(parts[4][:-len(".json")])
+        except ValueError:
+            return 400, None
+        if dataset is None:
+            return 404, None
+        if not (0 <= z <= MAX_ZOOM and 0 <= tile_x < (1 << z) and 0 <= tile_y < (1 << z)):
+            return 400, None
+        return 200, dataset.tile(z, tile_x, tile_y)
+
+    def start(self):
+        with self._lock:
+            if self._server is not None:
+                return self.url
+            tile_server = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def log_message(self, *args):
+                    pass
+
+                def do_GET(self):
+                    status, body = tile_server._respond(self.path.split("?", 1)[0])
+                    data = json.dumps(body, separators=(",", ":")).encode() if body is not None else b""
+                    self.send_response(status)
+                    # The map is embedded from another origin (the Streamlit component iframe)
+                    self.send_header("Access-Control-Allow-Origin", "*")
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(data)))
+                    if status == 200:
+                        self.send_header("Cache-Control", "public, max-age=86400, immutable")
+                    self.end_headers()
+                    self.wfile.write(data)
+
+            try:
+                self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+            except OSError:
+                if not self.port:
+                    raise
+                # Another app serves tiles there already; a free port still works for a browser on this machine
+                print(f"Tile server port {self.port} is in use, serving tiles on a free port instead")
+                self._server = ThreadingHTTPServer((self.host, 0), Handler)
+                self.public_url = None
+            self._server.daemon_threads = True
+            threading.Thread(target=self._server.serve_forever, name="tile-server", daemon=True).start()
+            return self.url
+
+    def stop(self):
+        with self._lock:
+            if self._server is not None:
+                self._server.shutdown()
+                self._server.server_close()
+                self._server = None
+
+    def register(self, dataset):
+        """Serve the dataset and return the tile URL template for Leaflet.
+
+        Registering a dataset again marks it as recently used, or brings it
+        back after it was dropped, so maps showing it keep their tiles.
+        """
+        self.start()
+        with self._lock:
+            self._datasets[dataset.id] = dataset
+            self._datasets.move_to_end(dataset.id)
+            while len(self._datasets) > MAX_DATASETS:
+                self._datasets.popitem(last=False)
+        return f"{self.url}/tiles/{dataset.id}/{{z}}/{{x}}/{{y}}.json"
+
+
+tile_server = TileServer()